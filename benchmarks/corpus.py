@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.corpus
+    ~~~~~~~~~~~~~~~~~
+
+    Synthetic Sphinx project generator.
+
+    The text is made of pseudo random words from a fixed seed, so the same
+    arguments always make the same project (and the same fragment keys).
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import argparse
+import os
+from os import path
+import random
+
+WORDS = ('polly', 'speech', 'audio', 'sphinx', 'builder', 'section', 'voice', 'document',
+         'fragment', 'sentence', 'paragraph', 'reader', 'listen', 'chapter', 'narrator',
+         'quiet', 'morning', 'river', 'mountain', 'window', 'garden', 'library', 'engine',
+         'request', 'answer', 'simple', 'careful', 'bright', 'slow', 'rapid', 'the', 'a',
+         'of', 'and', 'to', 'in', 'is', 'with', 'for', 'on', 'that', 'this', 'it', 'by')
+
+CONF = '''# generated by benchmarks/corpus.py
+project = 'SSML Benchmark'
+copyright = '2017, Benchmark'
+master_doc = 'index'
+extensions = ['sphinxcontrib.ssmlbuilder']
+ssml_polly_apply_docnames = '*'
+ssml_polly_rate_limit = %(rate_limit)r
+'''
+
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for i in range(rng.randint(6, 18))]
+    text = ' '.join(words)
+    if rng.random() < 0.3:
+        middle = len(words) // 2
+        text = ' '.join(words[:middle]) + ', ' + ' '.join(words[middle:])
+    return text[0].upper() + text[1:] + rng.choice('...?!')
+
+
+def paragraph(rng, sentences):
+    return ' '.join(sentence(rng) for i in range(sentences))
+
+
+def table(rng, rows=4, columns=3):
+    lines = ['.. list-table::', '   :header-rows: 1', '']
+    for row in range(rows):
+        for column in range(columns):
+            lines.append('   %s %s' % ('* -' if column == 0 else '  -', rng.choice(WORDS)))
+    return '\n'.join(lines)
+
+
+def code_block(rng, lines=8):
+    body = ['   %s = %s(%d)' % (rng.choice(WORDS), rng.choice(WORDS), i) for i in range(lines)]
+    return '\n'.join(['.. code-block:: python', ''] + body)
+
+
+def title(text, mark):
+    return '%s\n%s' % (text, mark * len(text))
+
+
+def document(rng, number, sections, paragraphs, sentences, tables, code_blocks):
+    blocks = [title('Document %d' % number, '=')]
+    for s in range(sections):
+        blocks.append(title('Section %d.%d %s' % (number, s + 1, rng.choice(WORDS)), '-'))
+        for p in range(paragraphs):
+            blocks.append(paragraph(rng, sentences))
+            if p == paragraphs // 2:
+                blocks.extend(table(rng) for i in range(tables))
+                blocks.extend(code_block(rng) for i in range(code_blocks))
+    return '\n\n'.join(blocks) + '\n'
+
+
+def docname(number):
+    return 'docs/doc%04d' % number
+
+
+def generate(outdir, docs=20, sections=4, paragraphs=6, sentences=5, tables=1,
+             code_blocks=1, seed=1, rate_limit=0):
+    """Write a project of ``docs`` documents into ``outdir``. Returns the docnames."""
+    rng = random.Random(seed)
+    os.makedirs(path.join(outdir, 'docs'), exist_ok=True)
+    with open(path.join(outdir, 'conf.py'), 'w') as f:
+        f.write(CONF % {'rate_limit': rate_limit})
+    docnames = [docname(i) for i in range(docs)]
+    index = [title('SSML Benchmark', '='), '.. toctree::\n\n' +
+             '\n'.join('   ' + name for name in docnames)]
+    with open(path.join(outdir, 'index.rst'), 'w') as f:
+        f.write('\n\n'.join(index) + '\n')
+    for i, name in enumerate(docnames):
+        with open(path.join(outdir, name + '.rst'), 'w') as f:
+            f.write(document(rng, i, sections, paragraphs, sentences, tables, code_blocks))
+    return docnames
+
+
+def edit(outdir, name, seed=2):
+    """Insert one sentence in the middle of the document ``name``."""
+    filename = path.join(outdir, name + '.rst')
+    with open(filename) as f:
+        blocks = f.read().split('\n\n')
+    middle = len(blocks) // 2
+    while blocks[middle].startswith(('..', ' ')) or '\n' in blocks[middle]:
+        middle += 1
+    blocks[middle] = sentence(random.Random(seed)) + ' ' + blocks[middle]
+    with open(filename, 'w') as f:
+        f.write('\n\n'.join(blocks))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2].strip())
+    parser.add_argument('outdir')
+    parser.add_argument('--docs', type=int, default=20)
+    parser.add_argument('--sections', type=int, default=4)
+    parser.add_argument('--paragraphs', type=int, default=6)
+    parser.add_argument('--sentences', type=int, default=5)
+    parser.add_argument('--tables', type=int, default=1)
+    parser.add_argument('--code-blocks', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    generate(args.outdir, args.docs, args.sections, args.paragraphs, args.sentences,
+             args.tables, args.code_blocks, args.seed)
+
+
+if __name__ == '__main__':
+    main()
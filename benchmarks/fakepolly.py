@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.fakepolly
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Local stand-in for the Polly ``SynthesizeSpeech`` API.
+
+    It answers ``POST /v1/speech`` with silent MPEG-2 layer III frames
+    whose play time is proportional to the billed characters. Latency,
+    a request quota and random throttling or service errors can be set to
+    reproduce the behaviour of the real service. ``GET /stats`` returns
+    the request counters as JSON.
+
+    The long-form task API is also served: ``POST /v1/synthesisTasks``
+    and ``GET /v1/synthesisTasks/<id>``. Task outputs (audio or SSML speech
+    marks) are kept in memory. Path style S3 ``GET``, ``HEAD``, ``PUT``,
+    ``DELETE`` and ``ListObjectsV2`` requests to ``/<bucket>/<key>`` are
+    served from the same memory, so the server can be the S3 endpoint of
+    the task API and of the remote fragment cache as well.
+
+    Run it standalone::
+
+        python benchmarks/fakepolly.py --port 8000 --latency 0.1 --quota 20
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import argparse
+import io
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+import uuid
+from xml.sax.saxutils import escape
+
+# MPEG-2 layer III, 48kbps, 22050Hz, mono: what Polly returns by default
+FRAME_HEADER = bytes([0xff, 0xf3, 0x60, 0xc0])
+FRAME_LENGTH = 576 // 8 * 48000 // 22050
+FRAME_SECONDS = 576 / 22050
+CHARACTERS_PER_SECOND = 15.0
+CHUNK_SIZE = 16 * 1024
+
+S3_LIST_KEYS = 1000
+
+TAG = re.compile(r'<[^>]*>')
+MARK = re.compile(r'<mark\s+name="([^"]*)"\s*/>')
+
+
+def billed_characters(text, text_type):
+    if text_type == 'ssml':
+        return len(TAG.sub('', text))
+    return len(text)
+
+
+def frame_count(characters):
+    return int(characters / CHARACTERS_PER_SECOND / FRAME_SECONDS)
+
+
+def audio(characters, frames=None):
+    if frames is None:
+        frames = frame_count(characters)
+    return (FRAME_HEADER + bytes(FRAME_LENGTH - 4)) * max(1, frames)
+
+
+def task_output(text, text_type, output_format):
+    """Audio of the task, or SSML speech marks at the same times as the audio."""
+    frames = 0
+    marks = []
+    position = 0
+    for match in MARK.finditer(text):
+        frames += frame_count(billed_characters(text[position:match.start()], text_type))
+        marks.append({'time': int(round(frames * FRAME_SECONDS * 1000)), 'type': 'ssml',
+                      'start': match.start(), 'end': match.end(), 'value': match.group(1)})
+        position = match.end()
+    frames += frame_count(billed_characters(text[position:], text_type))
+    if output_format == 'json':
+        return ''.join(json.dumps(mark) + '\n' for mark in marks).encode('utf-8')
+    return audio(0, frames)
+
+
+class Quota:
+    """Requests per second that the fake service accepts. ``0`` is unlimited."""
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+
+
+class FakePollyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, quota=0, throttle_rate=0.0,
+                 error_rate=0.0, seed=1, task_latency=1.0):
+        super().__init__(address, FakePollyHandler)
+        self.latency = latency
+        self.task_latency = task_latency
+        self.tasks = {}
+        self.objects = {}
+        self.jitter = jitter
+        self.quota = Quota(quota)
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'succeeded': 0, 'throttled': 0, 'errors': 0,
+                      'characters': 0, 'bytes': 0, 'inflight': 0, 'max_inflight': 0,
+                      'tasks': 0, 's3_requests': 0}
+
+    def count(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                self.stats[key] += value
+            self.stats['max_inflight'] = max(self.stats['max_inflight'], self.stats['inflight'])
+
+    def roll(self):
+        with self.lock:
+            return self.random.random(), self.random.uniform(0, self.jitter)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def start_task(self, body):
+        task_id = uuid.uuid4().hex
+        output_format = body.get('OutputFormat', 'mp3')
+        bucket = body.get('OutputS3BucketName', '')
+        key = '%s%s.%s' % (body.get('OutputS3KeyPrefix', ''), task_id,
+                           'marks' if output_format == 'json' else output_format)
+        text = body.get('Text', '')
+        text_type = body.get('TextType', 'text')
+        characters = billed_characters(text, text_type)
+        with self.lock:
+            self.objects[(bucket, key)] = task_output(text, text_type, output_format)
+            self.tasks[task_id] = {
+                'TaskId': task_id, 'TaskStatus': 'scheduled', 'OutputFormat': output_format,
+                'OutputUri': '%s/%s/%s' % (self.url, bucket, key),
+                'RequestCharacters': characters, 'VoiceId': body.get('VoiceId'),
+                'CreationTime': time.time(),
+                'ready': time.monotonic() + self.task_latency}
+        self.count(tasks=1, characters=characters)
+        return self.get_task(task_id)
+
+    def get_task(self, task_id):
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return None
+            if time.monotonic() >= task['ready']:
+                task['TaskStatus'] = 'completed'
+            elif task['TaskStatus'] == 'scheduled':
+                task['TaskStatus'] = 'inProgress'
+            return {key: value for key, value in task.items() if key != 'ready'}
+
+
+class FakePollyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_code(self, status, code, message):
+        self.send_json(status, {'message': message}, [('x-amzn-ErrorType', code)])
+
+    def s3_object(self):
+        bucket, _, key = urlsplit(self.path).path.lstrip('/').partition('/')
+        return unquote(bucket), unquote(key)
+
+    def send_xml(self, status, xml):
+        data = ('<?xml version="1.0" encoding="UTF-8"?>\n' + xml).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def send_s3_error(self, status, code):
+        self.send_xml(status, '<Error><Code>%s</Code><Message>%s</Message></Error>' % (code, code))
+
+    def read_body(self):
+        """Request body. Chunked transfer and aws-chunked content are decoded."""
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            data = self.read_chunks()
+        else:
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'aws-chunked' in self.headers.get('Content-Encoding', '') or \
+                self.headers.get('x-amz-content-sha256', '').startswith('STREAMING-'):
+            data = self.read_chunks(io.BytesIO(data))
+        return data
+
+    def read_chunks(self, f=None):
+        f = f or self.rfile
+        chunks = []
+        while True:
+            size = int(f.readline().split(b';')[0].strip() or b'0', 16)
+            if not size:
+                # trailers
+                while f.readline().strip():
+                    pass
+                return b''.join(chunks)
+            chunks.append(f.read(size))
+            f.readline()
+
+    def list_objects(self, bucket):
+        query = parse_qs(urlsplit(self.path).query)
+        prefix = query.get('prefix', [''])[0]
+        start = query.get('continuation-token', query.get('start-after', ['']))[0]
+        with self.server.lock:
+            names = sorted((key, len(data)) for (name, key), data in self.server.objects.items()
+                           if name == bucket and key.startswith(prefix) and key > start)
+        page = names[:S3_LIST_KEYS]
+        truncated = len(names) > len(page)
+        xml = ['<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+               '<Name>%s</Name><Prefix>%s</Prefix>' % (escape(bucket), escape(prefix)),
+               '<KeyCount>%d</KeyCount><MaxKeys>%d</MaxKeys>' % (len(page), S3_LIST_KEYS),
+               '<IsTruncated>%s</IsTruncated>' % ('true' if truncated else 'false')]
+        if truncated:
+            xml.append('<NextContinuationToken>%s</NextContinuationToken>' % escape(page[-1][0]))
+        for key, size in page:
+            xml.append('<Contents><Key>%s</Key><Size>%d</Size></Contents>' % (escape(key), size))
+        xml.append('</ListBucketResult>')
+        self.send_xml(200, ''.join(xml))
+
+    def get_object(self):
+        server = self.server
+        server.count(s3_requests=1)
+        bucket, key = self.s3_object()
+        if not key:
+            self.list_objects(bucket)
+            return
+        with server.lock:
+            data = server.objects.get((bucket, key))
+        if data is None:
+            self.send_s3_error(404, 'NoSuchKey')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+            server.count(bytes=len(data))
+
+    do_HEAD = get_object
+
+    def do_PUT(self):
+        data = self.read_body()
+        with self.server.lock:
+            self.server.objects[self.s3_object()] = data
+        self.server.count(s3_requests=1)
+        self.send_response(200)
+        self.send_header('ETag', '"%d"' % len(data))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/stats':
+            with server.lock:
+                self.send_json(200, server.stats)
+        elif self.path.startswith('/v1/synthesisTasks/'):
+            task = server.get_task(self.path.rsplit('/', 1)[1])
+            if task is None:
+                self.send_error_code(404, 'SynthesisTaskNotFoundException', self.path)
+            else:
+                self.send_json(200, {'SynthesisTask': task})
+        else:
+            self.get_object()
+
+    def do_DELETE(self):
+        with self.server.lock:
+            self.server.objects.pop(self.s3_object(), None)
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path == '/v1/synthesisTasks':
+            self.post_task(body)
+            return
+        if self.path != '/v1/speech':
+            self.send_error_code(404, 'NotFoundException', self.path)
+            return
+        server.count(requests=1, inflight=1)
+        try:
+            dice, jitter = server.roll()
+            if not server.quota.take() or dice < server.throttle_rate:
+                server.count(throttled=1)
+                self.send_error_code(400, 'ThrottlingException', 'Rate exceeded')
+                return
+            time.sleep(server.latency + jitter)
+            if dice < server.throttle_rate + server.error_rate:
+                server.count(errors=1)
+                self.send_error_code(500, 'ServiceFailureException', 'Internal error')
+                return
+            characters = billed_characters(body.get('Text', ''), body.get('TextType', 'text'))
+            data = audio(characters)
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mpeg')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('x-amzn-RequestCharacters', str(characters))
+            self.end_headers()
+            for i in range(0, len(data), CHUNK_SIZE):
+                self.wfile.write(data[i:i + CHUNK_SIZE])
+            server.count(succeeded=1, characters=characters, bytes=len(data))
+        finally:
+            server.count(inflight=-1)
+
+    def post_task(self, body):
+        server = self.server
+        server.count(requests=1)
+        dice, jitter = server.roll()
+        if not server.quota.take() or dice < server.throttle_rate:
+            server.count(throttled=1)
+            self.send_error_code(400, 'ThrottlingException', 'Rate exceeded')
+            return
+        time.sleep(server.latency + jitter)
+        self.send_json(200, {'SynthesisTask': server.start_task(body)})
+        server.count(succeeded=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for Amazon Polly.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='0 picks a free port')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency (seconds)')
+    parser.add_argument('--quota', type=float, default=0, help='accepted requests per second')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='ratio of requests rejected by ThrottlingException')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='ratio of requests failed by ServiceFailureException')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--task-latency', type=float, default=1.0,
+                        help='seconds until a synthesis task is completed')
+    args = parser.parse_args(argv)
+    server = FakePollyServer((args.host, args.port), args.latency, args.jitter, args.quota,
+                             args.throttle_rate, args.error_rate, args.seed, args.task_latency)
+    # the first line tells the URL to the parent process
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
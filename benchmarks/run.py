@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.run
+    ~~~~~~~~~~~~~~
+
+    End-to-end benchmark of the ``ssml`` builder.
+
+    It generates a synthetic project (:mod:`corpus`), starts the local
+    Polly stand-in (:mod:`fakepolly`) and builds the project three times:
+
+    ``cold``
+        from scratch: every fragment is written and synthesized.
+    ``noop``
+        again without changes.
+    ``edit``
+        after inserting one sentence into one document.
+
+    Every build runs in its own process, so the peak RSS is per build.
+    The write, manifest, synthesis and assembly phases are timed by
+    wrapping the builder methods. Results are saved as
+    ``results/<commit>[-<label>].json`` and can be compared with
+    ``--compare``.
+
+    ``--check-parallel`` builds the same project serially and with
+    ``-j auto`` and checks that the SSML, manifests and MP3 files are
+    byte-identical.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import argparse
+import datetime
+import filecmp
+import io
+import json
+import os
+from os import path
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import corpus
+
+HERE = path.dirname(path.abspath(__file__))
+RESULTS_DIR = path.join(HERE, 'results')
+
+# (phase, module, class, method)
+PHASES = [
+    ('read', 'sphinx.builders', 'Builder', 'read'),
+    ('write', 'sphinxcontrib.builder', 'SSMLBuilder', 'write'),
+    ('manifest', 'sphinxcontrib.builder', 'SSMLBuilder', 'load_fragment_manifest'),
+    ('manifest', 'sphinxcontrib.builder', 'SSMLBuilder', 'update_fragment_manifest'),
+    ('synthesis', 'sphinxcontrib.synthesis', 'BackgroundSynthesizer', 'join'),
+    ('assembly', 'sphinxcontrib.builder', 'SSMLBuilder', 'assemble'),
+]
+
+# metrics printed by --compare: (key, higher is better)
+TRACKED = [('total', False), ('fragments_per_sec', True), ('docs_per_sec', True),
+           ('peak_rss_mib', False), ('write', False), ('manifest', False),
+           ('synthesis', False), ('assembly', False)]
+
+# files that differ between builds by design
+IGNORED = ('index.sqlite', 'index.sqlite-wal', 'index.sqlite-shm', '.buildinfo',
+           # timings
+           '_report.json')
+
+
+class PhaseTimer:
+    """Accumulate wall time of the wrapped methods by phase."""
+    def __init__(self):
+        self.phases = {}
+        self._saved = []
+
+    def wrap(self, phase, owner, name, record=None):
+        original = getattr(owner, name, None)
+        if original is None:
+            return
+        timer = self
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = original(*args, **kwargs)
+            finally:
+                timer.phases[phase] = timer.phases.get(phase, 0.0) + time.perf_counter() - start
+            if record:
+                record(args[0], result)
+            return result
+        self._saved.append((owner, name, owner.__dict__.get(name)))
+        setattr(owner, name, wrapper)
+
+    def restore(self):
+        for owner, name, original in reversed(self._saved):
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+        self._saved = []
+
+
+def peak_rss_mib(who):
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def build(project, polly_url, jobs, report, backend='polly'):
+    """Build ``project`` in this process and write the measurements to ``report``."""
+    import importlib
+    from sphinx.application import Sphinx
+    from sphinxcontrib.synthesis import BackgroundSynthesizer
+
+    timer = PhaseTimer()
+    marks = {}
+
+    def record_join(synthesizer, result):
+        marks['synthesized'] = len(result[0])
+        marks['failed'] = len(result[1])
+        marks['synthesis_wall'] = time.perf_counter() - marks['synthesis_start']
+
+    for phase, module, cls, method in PHASES:
+        owner = getattr(importlib.import_module(module), cls)
+        timer.wrap(phase, owner, method, record_join if method == 'join' else None)
+
+    original_init = BackgroundSynthesizer.__init__
+
+    def init(self, engine):
+        marks.setdefault('synthesis_start', time.perf_counter())
+        original_init(self, engine)
+    BackgroundSynthesizer.__init__ = init
+
+    warnings = io.StringIO()
+    start = time.perf_counter()
+    app = Sphinx(project, project, path.join(project, '_build', 'ssml'),
+                 path.join(project, '_build', 'doctrees'), 'ssml',
+                 confoverrides={'ssml_polly_endpoint_url': polly_url,
+                                'ssml_polly_s3_endpoint_url': polly_url,
+                                'ssml_polly_task_bucket': 'benchmark',
+                                'ssml_tts_backend': backend},
+                 status=None, warning=warnings, parallel=jobs)
+    setup = time.perf_counter() - start
+    app.build()
+    total = time.perf_counter() - start
+    BackgroundSynthesizer.__init__ = original_init
+    timer.restore()
+    # the report of the builder itself
+    with open(path.join(project, 'polly', '_report.json')) as f:
+        builder_report = json.load(f)
+
+    result = dict(timer.phases)
+    result.update({
+        'setup': setup,
+        'total': total,
+        'written_docs': len(app.builder.written_docnames),
+        'fragments': sum(len(d['sequence']) for d in app.builder.fragments.values()),
+        'synthesized': marks.get('synthesized', 0),
+        'failed': marks.get('failed', 0),
+        'synthesis_wall': marks.get('synthesis_wall', 0.0),
+        'warnings': len([line for line in warnings.getvalue().splitlines() if 'WARNING' in line]),
+        'peak_rss_mib': peak_rss_mib(resource.RUSAGE_SELF),
+        'peak_child_rss_mib': peak_rss_mib(resource.RUSAGE_CHILDREN),
+        'counters': builder_report['counters'],
+        'latency': builder_report['latency'],
+        'cache_hit_ratio': builder_report['cache_hit_ratio'],
+    })
+    with open(report, 'w') as f:
+        json.dump(result, f)
+
+
+def polly_stats(url):
+    with urllib.request.urlopen(url + '/stats') as response:
+        return json.load(response)
+
+
+def start_polly(args):
+    command = [sys.executable, path.join(HERE, 'fakepolly.py'),
+               '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--quota', str(args.quota), '--throttle-rate', str(args.throttle_rate),
+               '--error-rate', str(args.error_rate), '--task-latency', str(args.task_latency)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    return process, process.stdout.readline().strip()
+
+
+def run_build(project, polly_url, jobs, log, backend='polly'):
+    """Run :func:`build` in a child process and add the API counters of the fake service."""
+    env = dict(os.environ, AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark',
+               AWS_DEFAULT_REGION='us-east-1')
+    env.pop('AWS_PROFILE', None)
+    report = path.join(project, '_report.json')
+    before = polly_stats(polly_url)
+    with open(log, 'a') as out:
+        # the audio output folder is relative to the working directory
+        subprocess.run([sys.executable, path.abspath(__file__), 'build', project, polly_url,
+                        '--jobs', str(jobs), '--report', report, '--backend', backend],
+                       cwd=project, env=env, stdout=out, stderr=subprocess.STDOUT, check=True)
+    after = polly_stats(polly_url)
+    with open(report) as f:
+        result = json.load(f)
+    os.remove(report)
+    for key in ('requests', 'throttled', 'errors', 'characters', 'bytes'):
+        result['api_' + key] = after[key] - before[key]
+    result['fragments_per_sec'] = (result['synthesized'] / result['synthesis_wall']
+                                   if result['synthesis_wall'] else 0.0)
+    result['docs_per_sec'] = (result['written_docs'] / result['write']
+                              if result.get('write') else 0.0)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def corpus_options(args):
+    return {'docs': args.docs, 'sections': args.sections, 'paragraphs': args.paragraphs,
+            'sentences': args.sentences, 'tables': args.tables, 'code_blocks': args.code_blocks,
+            'rate_limit': args.rate_limit}
+
+
+def benchmark(args, workdir, polly_url):
+    project = path.join(workdir, 'project')
+    log = path.join(workdir, 'build.log')
+    docnames = corpus.generate(project, **corpus_options(args))
+    scenarios = {}
+    for scenario in ('cold', 'noop', 'edit'):
+        if scenario == 'edit':
+            corpus.edit(project, docnames[len(docnames) // 2])
+        result = scenarios[scenario] = run_build(project, polly_url, args.jobs, log,
+                                                 args.backend)
+        print('%-5s %7.2fs  write %6.2fs  synthesis %6.2fs  assembly %6.2fs  '
+              '%4d fragments synthesized  %7.1f fragments/s  %6.1f docs/s  %6.1f MiB' % (
+                  scenario, result['total'], result.get('write', 0), result.get('synthesis', 0),
+                  result.get('assembly', 0), result['synthesized'], result['fragments_per_sec'],
+                  result['docs_per_sec'], result['peak_rss_mib']))
+    return scenarios
+
+
+def compare_trees(left, right):
+    """Return relative paths of the files that differ between two directories."""
+    differences = []
+    comparison = filecmp.dircmp(left, right, ignore=list(IGNORED) + ['doctrees'])
+
+    def walk(comparison, prefix):
+        differences.extend(path.join(prefix, name) for name in
+                           comparison.left_only + comparison.right_only + comparison.funny_files)
+        match, mismatch, errors = filecmp.cmpfiles(comparison.left, comparison.right,
+                                                   comparison.common_files, shallow=False)
+        differences.extend(path.join(prefix, name) for name in mismatch + errors)
+        for name, sub in comparison.subdirs.items():
+            walk(sub, path.join(prefix, name))
+    walk(comparison, '')
+    return sorted(differences)
+
+
+def check_parallel(args, workdir, polly_url):
+    """Build the same project serially and in parallel and compare the outputs."""
+    jobs = args.jobs if args.jobs > 1 else (os.cpu_count() or 2)
+    projects = {}
+    for mode, count in (('serial', 1), ('parallel', jobs)):
+        project = projects[mode] = path.join(workdir, mode)
+        corpus.generate(project, **corpus_options(args))
+        run_build(project, polly_url, count, path.join(workdir, mode + '.log'))
+    differences = []
+    for folder in (path.join('_build', 'ssml'), 'polly'):
+        differences += [path.join(folder, name) for name in
+                        compare_trees(path.join(projects['serial'], folder),
+                                      path.join(projects['parallel'], folder))]
+    if differences:
+        print('-j %d output differs from serial output:' % jobs)
+        for name in differences:
+            print('  ' + name)
+        return False
+    print('-j %d output is byte-identical to serial output' % jobs)
+    return True
+
+
+def compare(current, filename):
+    with open(filename) as f:
+        baseline = json.load(f)
+    print('compared with %s (%s)' % (baseline['commit'], filename))
+    for scenario, result in current['scenarios'].items():
+        old = baseline['scenarios'].get(scenario)
+        if not old:
+            continue
+        print(scenario)
+        for key, higher_is_better in TRACKED:
+            if not old.get(key) or key not in result:
+                continue
+            ratio = result[key] / old[key]
+            better = ratio > 1 if higher_is_better else ratio < 1
+            print('  %-18s %10.3f -> %10.3f  %+6.1f%% %s' % (
+                key, old[key], result[key], (ratio - 1) * 100,
+                '' if abs(ratio - 1) < 0.05 else ('better' if better else 'worse')))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['build']:
+        parser = argparse.ArgumentParser(prog='run.py build')
+        parser.add_argument('project')
+        parser.add_argument('polly_url')
+        parser.add_argument('--jobs', type=int, default=1)
+        parser.add_argument('--report', required=True)
+        parser.add_argument('--backend', default='polly')
+        args = parser.parse_args(argv[1:])
+        build(args.project, args.polly_url, args.jobs, args.report, args.backend)
+        return 0
+
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the ssml builder.')
+    group = parser.add_argument_group('corpus')
+    group.add_argument('--docs', type=int, default=20)
+    group.add_argument('--sections', type=int, default=4)
+    group.add_argument('--paragraphs', type=int, default=6)
+    group.add_argument('--sentences', type=int, default=5)
+    group.add_argument('--tables', type=int, default=1)
+    group.add_argument('--code-blocks', type=int, default=1)
+    group = parser.add_argument_group('fake Polly')
+    group.add_argument('--latency', type=float, default=0.05)
+    group.add_argument('--jitter', type=float, default=0.0)
+    group.add_argument('--quota', type=float, default=0)
+    group.add_argument('--throttle-rate', type=float, default=0.0)
+    group.add_argument('--error-rate', type=float, default=0.0)
+    group.add_argument('--task-latency', type=float, default=1.0,
+                       help='seconds until a synthesis task is completed')
+    group = parser.add_argument_group('build')
+    group.add_argument('-j', '--jobs', type=int, default=1)
+    group.add_argument('--rate-limit', type=float, default=0,
+                       help='ssml_polly_rate_limit of the project (0: unlimited)')
+    group.add_argument('--backend', default='polly', choices=('polly', 'polly-task'),
+                       help='ssml_tts_backend of the project')
+    parser.add_argument('--label', default='', help='suffix of the result file name')
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--compare', metavar='RESULT', help='result file to compare with')
+    parser.add_argument('--check-parallel', action='store_true',
+                        help='only check that parallel and serial outputs are identical')
+    parser.add_argument('--keep', action='store_true', help="don't remove the work directory")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='ssml-bench-')
+    polly, polly_url = start_polly(args)
+    try:
+        if args.check_parallel:
+            return 0 if check_parallel(args, workdir, polly_url) else 1
+        commit = git_commit()
+        current = {
+            'commit': commit,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'options': vars(args),
+            'scenarios': benchmark(args, workdir, polly_url),
+        }
+        os.makedirs(args.results_dir, exist_ok=True)
+        filename = path.join(args.results_dir, commit + ('-' + args.label if args.label else '')
+                             + '.json')
+        with open(filename, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print('saved %s' % filename)
+        if args.compare:
+            compare(current, args.compare)
+        return 0
+    finally:
+        polly.terminate()
+        polly.wait()
+        if args.keep:
+            print('work directory: %s' % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
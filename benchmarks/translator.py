@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.translator
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Doctree walk benchmark of :class:`~sphinxcontrib.writer.SSMLTranslator`.
+
+    It generates a project of large documents (:mod:`corpus`), reads it
+    by Sphinx in plan mode (no Polly calls), and times the walk of every
+    resolved doctree. ``--baseline REV`` loads ``sphinxcontrib/writer.py``
+    of a git revision and times its translator on the same doctrees::
+
+        python benchmarks/translator.py --docs 50 --sections 20 --baseline HEAD~1
+
+    Fragment files are written on the warm-up walk only, so the timed
+    walks measure the translation, chunking and hashing. ``--memory`` also
+    traces the peak memory allocated during a walk, which shows how much
+    content the translator holds for a long section::
+
+        python benchmarks/translator.py --docs 5 --sections 1 --paragraphs 2000 --memory
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import argparse
+import importlib.util
+import os
+from os import path
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import corpus
+
+HERE = path.dirname(path.abspath(__file__))
+
+
+def load_translator(revision):
+    """``SSMLTranslator`` of ``sphinxcontrib/writer.py`` at the git ``revision``."""
+    source = subprocess.check_output(['git', 'show', '%s:sphinxcontrib/writer.py' % revision],
+                                     cwd=HERE)
+    # the relative imports resolve to the current package
+    spec = importlib.util.spec_from_loader('sphinxcontrib.writer_' + revision.replace('~', '_'),
+                                           loader=None)
+    module = importlib.util.module_from_spec(spec)
+    module.__package__ = 'sphinxcontrib'
+    exec(compile(source, 'writer.py@' + revision, 'exec'), module.__dict__)
+    return module.SSMLTranslator
+
+
+def walk_times(app, doctrees, translator_class, repeat):
+    """Return the best walk time of each document in seconds."""
+    builder = app.builder
+    times = {}
+    for docname, doctree in doctrees.items():
+        basepath = path.join(builder.outdir, docname)
+        best = None
+        for i in range(repeat + 1):
+            destination = {"hashes": {}, "sequence": [], "title": ""}
+            visitor = translator_class(doctree, builder, destination, docname, basepath)
+            start = time.perf_counter()
+            doctree.walkabout(visitor)
+            elapsed = time.perf_counter() - start
+            if i == 0:
+                # warm-up. the fragments are written, and the later walks skip them
+                builder.fragments[docname] = dict(builder.fragments.get(docname, {}),
+                                                  hashes=destination["hashes"])
+                continue
+            best = elapsed if best is None else min(best, elapsed)
+        times[docname] = best
+    return times
+
+
+def walk_peaks(app, doctrees, translator_class):
+    """Return the peak memory allocated by the walk of each document in bytes."""
+    builder = app.builder
+    peaks = {}
+    for docname, doctree in doctrees.items():
+        destination = {"hashes": {}, "sequence": [], "title": ""}
+        visitor = translator_class(doctree, builder, destination, docname,
+                                   path.join(builder.outdir, docname))
+        tracemalloc.start()
+        try:
+            doctree.walkabout(visitor)
+            peaks[docname] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return peaks
+
+
+def summary(times):
+    values = sorted(times.values())
+    return {'docs': len(values), 'total': sum(values), 'mean': statistics.mean(values),
+            'median': statistics.median(values), 'max': values[-1]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Doctree walk benchmark of SSMLTranslator.')
+    group = parser.add_argument_group('corpus')
+    group.add_argument('--docs', type=int, default=30)
+    group.add_argument('--sections', type=int, default=20)
+    group.add_argument('--paragraphs', type=int, default=8)
+    group.add_argument('--sentences', type=int, default=6)
+    group.add_argument('--tables', type=int, default=2)
+    group.add_argument('--code-blocks', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=5, help='timed walks per document')
+    parser.add_argument('--baseline', metavar='REV', help='git revision to compare with')
+    parser.add_argument('--memory', action='store_true', help='trace the peak memory of the walks')
+    args = parser.parse_args(argv)
+
+    from sphinx.application import Sphinx
+    from sphinxcontrib.writer import SSMLTranslator
+
+    translators = [('current', SSMLTranslator)]
+    if args.baseline:
+        translators.append((args.baseline, load_translator(args.baseline)))
+
+    workdir = tempfile.mkdtemp(prefix='ssml-walk-')
+    cwd = os.getcwd()
+    try:
+        project = path.join(workdir, 'project')
+        corpus.generate(project, args.docs, args.sections, args.paragraphs, args.sentences,
+                        args.tables, args.code_blocks)
+        # the audio output folder is relative to the working directory
+        os.chdir(project)
+        app = Sphinx(project, project, path.join(project, '_build', 'ssml'),
+                     path.join(project, '_build', 'doctrees'), 'ssml',
+                     confoverrides={'ssml_polly_plan_only': True}, status=None)
+        app.build()
+        doctrees = {docname: app.env.get_and_resolve_doctree(docname, app.builder)
+                    for docname in sorted(app.env.found_docs)}
+        app.builder.prepare_writing(set(doctrees))
+        results = {}
+        for name, translator_class in translators:
+            results[name] = summary(walk_times(app, doctrees, translator_class, args.repeat))
+            result = results[name]
+            print('%-10s %4d docs  mean %8.3fms  median %8.3fms  max %8.3fms  total %7.3fs' % (
+                name, result['docs'], result['mean'] * 1000, result['median'] * 1000,
+                result['max'] * 1000, result['total']))
+            if args.memory:
+                peak = max(walk_peaks(app, doctrees, translator_class).values())
+                result['peak'] = peak
+                print('%-10s peak walk memory %8.1fKiB' % (name, peak / 1024))
+        if args.baseline:
+            print('speedup: %.2fx' % (results[args.baseline]['mean'] / results['current']['mean']))
+            if args.memory:
+                print('peak memory: %.2fx' % (results[args.baseline]['peak'] /
+                                              results['current']['peak']))
+        return 0
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -41,5 +41,8 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=requires,
+    extras_require={
+        'async': ['aiobotocore'],
+    },
     namespace_packages=['sphinxcontrib'],
 )
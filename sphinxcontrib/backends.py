@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib.backends
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Speech synthesis backends.
+
+    A backend makes the clients that :class:`~sphinxcontrib.synthesis.SynthesisEngine`
+    drives, and declares how they should be driven: request rate, concurrency,
+    retries and how many fragments fit in one request. Polly clients can be
+    sharded over AWS profiles and regions by ``ssml_polly_shards``.
+
+    * :class:`PollyBackend`: Amazon Polly.
+    * :class:`PollyTaskBackend`: Amazon Polly's asynchronous task API. Many
+      fragments are synthesized by one task through an S3 bucket.
+    * :class:`EspeakBackend`: local espeak-ng (and ffmpeg for MP3 encoding).
+    * :class:`SilenceBackend`: silence as long as the text would be read.
+      It needs nothing, and is handy for CI and for checking the pipeline.
+
+    The offline backends run fragments in a process pool. Their audio has
+    the same format as Polly's, so the cache and assembly are shared.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import functools
+import os
+import re
+import subprocess
+
+from botocore.exceptions import BotoCoreError, ClientError
+from sphinx.errors import ConfigError
+
+from . import mp3
+from .chunker import billed_characters, split_ssml
+from .synthesis import PollyTaskClient, ProcessPoolClient, Shard, create_polly_client
+from .throttling import Throttle
+
+THROTTLE_ERRORS = ('ThrottlingException', 'Throttling', 'TooManyRequestsException',
+                   'RequestLimitExceeded')
+RETRYABLE_ERRORS = ('ServiceFailureException', 'ServiceUnavailableException',
+                    'InternalFailure')
+
+# sample rate of Polly's MP3 output
+DEFAULT_SAMPLE_RATE = 22050
+
+# reading speed for the length of silence
+CHARACTERS_PER_SECOND = 15.0
+
+BREAK = re.compile(r'<break\s+time="(\d+(?:\.\d+)?)(ms|s)"')
+
+
+def error_code(err):
+    if isinstance(err, ClientError):
+        return err.response.get('Error', {}).get('Code', '')
+    return ''
+
+
+def is_throttle(err):
+    return error_code(err) in THROTTLE_ERRORS
+
+
+def split_too_long(err, text):
+    if error_code(err) == 'TextLengthExceededException':
+        return split_ssml(text)
+    return None
+
+
+def is_retryable(err):
+    # connection errors and 5xx responses are worth another try
+    return isinstance(err, BotoCoreError) or error_code(err) in RETRYABLE_ERRORS
+
+
+class Backend:
+    """Base class of the backends. ``builder`` is :class:`~sphinxcontrib.builder.SSMLBuilder`.
+
+    Subclasses set the scheduling attributes in ``__init__`` and implement
+    :meth:`create_client`.
+    """
+    name = None
+    #: requests per second (``0``: unlimited) and burst
+    rate_limit = 0
+    rate_burst = None
+    #: initial and maximum in-flight requests
+    concurrency = 1
+    max_concurrency = 1
+    max_retries = 0
+    #: fragments that one request can carry, and their billed characters
+    batch_size = 1
+    batch_characters = None
+    #: times each character is billed
+    billed_passes = 1
+    #: fragments can be synthesized while Sphinx is still writing
+    incremental = True
+
+    def __init__(self, builder):
+        self.builder = builder
+
+    @property
+    def params(self):
+        """Cache key parameters that identify the backend."""
+        return {"backend": self.name}
+
+    def create_client(self):
+        raise NotImplementedError
+
+    def create_throttle(self):
+        return Throttle(self.rate_limit, burst=self.rate_burst, concurrency=self.concurrency,
+                        max_concurrency=self.max_concurrency, max_retries=self.max_retries)
+
+    def create_shards(self):
+        """:class:`~sphinxcontrib.synthesis.Shard` list that requests are spread over."""
+        return [Shard(self.name, self.create_client(), self.create_throttle())]
+
+    def split(self, err, text):
+        """SSML documents to synthesize instead of ``text`` that is rejected by ``err``."""
+        return None
+
+
+class PollyBackend(Backend):
+    """Amazon Polly. Each entry of ``ssml_polly_shards`` is a client of its own
+    profile, region, rate limit and concurrency; the global settings fill
+    the missing keys. ``rate_limit`` and ``max_concurrency`` are the totals.
+    """
+    name = 'polly'
+
+    def __init__(self, builder):
+        super().__init__(builder)
+        self.max_retries = builder.ssml_polly_max_retries
+        self.shards = self.shard_settings()
+        rates = [shard["rate_limit"] for shard in self.shards]
+        # a shard without limit makes the total unlimited
+        self.rate_limit = sum(rates) if all(rates) else 0
+        self.rate_burst = builder.ssml_polly_rate_burst
+        self.concurrency = sum(shard["concurrency"] for shard in self.shards)
+        self.max_concurrency = sum(shard["max_concurrency"] for shard in self.shards)
+
+    def shard_defaults(self):
+        builder = self.builder
+        return {"name": self.name,
+                "profile": builder.ssml_polly_aws_profile,
+                "region": None,
+                "endpoint_url": builder.ssml_polly_endpoint_url,
+                "rate_limit": builder.ssml_polly_rate_limit,
+                "rate_burst": builder.ssml_polly_rate_burst,
+                "concurrency": builder.ssml_polly_concurrency,
+                "max_concurrency": builder.ssml_polly_max_concurrency}
+
+    def shard_settings(self):
+        defaults = self.shard_defaults()
+        shards = []
+        for i, shard in enumerate(self.builder.ssml_polly_shards or [{}]):
+            unknown = set(shard) - set(defaults)
+            if unknown:
+                raise ConfigError('unknown keys in ssml_polly_shards[%d]: %s' % (
+                    i, ', '.join(sorted(unknown))))
+            settings = dict(defaults, **shard)
+            if "name" not in shard and self.builder.ssml_polly_shards:
+                settings["name"] = '%s/%s' % (settings["profile"] or 'default',
+                                              settings["region"] or 'default')
+            shards.append(settings)
+        names = [shard["name"] for shard in shards]
+        if len(set(names)) != len(names):
+            raise ConfigError('names of ssml_polly_shards are not unique: %s' % ', '.join(names))
+        return shards
+
+    @property
+    def params(self):
+        # Polly keeps the cache keys of the versions without backends
+        return {}
+
+    def request(self):
+        builder = self.builder
+        request = {"VoiceId": builder.ssml_polly_aws_voiceid,
+                   "TextType": "ssml",
+                   "OutputFormat": "mp3"}
+        if builder.ssml_polly_engine != 'standard':
+            request["Engine"] = builder.ssml_polly_engine
+        if builder.ssml_polly_sample_rate:
+            request["SampleRate"] = str(builder.ssml_polly_sample_rate)
+        return request
+
+    def create_client(self, shard=None):
+        shard = shard or self.shards[0]
+        # connection pool as large as the concurrency of the shard
+        return create_polly_client(shard["profile"], self.request(), shard["endpoint_url"],
+                                   shard["max_concurrency"], shard["region"])
+
+    def create_throttle(self, shard=None):
+        builder = self.builder
+        shard = shard or self.shards[0]
+        return Throttle(shard["rate_limit"],
+                        burst=shard["rate_burst"],
+                        concurrency=shard["concurrency"],
+                        max_concurrency=shard["max_concurrency"],
+                        max_retries=self.max_retries,
+                        backoff_base=builder.ssml_polly_backoff_base,
+                        backoff_max=builder.ssml_polly_backoff_max,
+                        is_throttle=is_throttle,
+                        is_retryable=is_retryable)
+
+    def create_shards(self):
+        return [Shard(shard["name"], self.create_client(shard), self.create_throttle(shard))
+                for shard in self.shards]
+
+    def split(self, err, text):
+        return split_too_long(err, text)
+
+
+class PollyTaskBackend(PollyBackend):
+    """Polly's long-form task API.
+
+    Fragments are batched up to ``ssml_polly_task_characters`` billed
+    characters per task, so synthesis starts after all documents are written.
+    The audio of a fragment is cut from the task output at its speech mark,
+    so it is not the same as :class:`PollyBackend`'s, and has its own cache keys.
+    """
+    name = 'polly-task'
+    batch_size = 10000
+    # the audio and the speech marks tasks are billed for the same text
+    billed_passes = 2
+    incremental = False
+
+    def __init__(self, builder):
+        super().__init__(builder)
+        if not builder.ssml_polly_task_bucket:
+            raise ConfigError('ssml_polly_task_bucket is required by polly-task backend')
+        self.batch_characters = builder.ssml_polly_task_characters
+
+    @property
+    def params(self):
+        return {"backend": self.name}
+
+    def shard_defaults(self):
+        # the output bucket should be in the region of the shard
+        return dict(super().shard_defaults(), bucket=self.builder.ssml_polly_task_bucket)
+
+    def create_client(self, shard=None):
+        builder = self.builder
+        shard = shard or self.shards[0]
+        return PollyTaskClient(shard["profile"], self.request(), shard["bucket"],
+                               builder.ssml_polly_task_prefix, shard["endpoint_url"],
+                               builder.ssml_polly_s3_endpoint_url, shard["max_concurrency"],
+                               region=shard["region"])
+
+
+def render_silence(text, sample_rate):
+    """Silence for the reading time of ``text`` and its ``<break>`` tags."""
+    seconds = billed_characters(text) / CHARACTERS_PER_SECOND
+    for value, unit in BREAK.findall(text):
+        seconds += float(value) / (1000.0 if unit == 'ms' else 1.0)
+    return mp3.silence(seconds, sample_rate)
+
+
+def render_espeak(text, voice, sample_rate):
+    """Read ``text`` by espeak-ng and encode it to MP3 by ffmpeg."""
+    wav = subprocess.run(['espeak-ng', '-m', '-v', voice, '--stdin', '--stdout'],
+                         input=text.encode('utf-8'), stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, check=True).stdout
+    # mono 48kbps like Polly, without ID3 tag and Xing header
+    return subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'wav', '-i', 'pipe:0',
+                           '-ar', str(sample_rate), '-ac', '1', '-b:a', '48k',
+                           '-id3v2_version', '0', '-write_xing', '0', '-f', 'mp3', 'pipe:1'],
+                          input=wav, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          check=True).stdout
+
+
+class OfflineBackend(Backend):
+    """Backend that renders fragments locally in a process pool of ``ssml_tts_workers``."""
+    def __init__(self, builder):
+        super().__init__(builder)
+        self.sample_rate = int(builder.ssml_polly_sample_rate or DEFAULT_SAMPLE_RATE)
+        self.max_concurrency = self.concurrency = builder.ssml_tts_workers or os.cpu_count() or 1
+
+    @property
+    def params(self):
+        return {"backend": self.name, "sample_rate": self.sample_rate}
+
+    def renderer(self):
+        """Picklable function that returns MP3 data for SSML text."""
+        raise NotImplementedError
+
+    def create_client(self):
+        return ProcessPoolClient(self.renderer(), self.max_concurrency)
+
+
+class SilenceBackend(OfflineBackend):
+    name = 'silence'
+
+    def renderer(self):
+        return functools.partial(render_silence, sample_rate=self.sample_rate)
+
+
+class EspeakBackend(OfflineBackend):
+    name = 'espeak'
+
+    def __init__(self, builder):
+        super().__init__(builder)
+        self.voice = builder.ssml_language.lower()
+
+    @property
+    def params(self):
+        return dict(super().params, voice=self.voice)
+
+    def renderer(self):
+        return functools.partial(render_espeak, voice=self.voice, sample_rate=self.sample_rate)
+
+
+BACKENDS = {backend.name: backend for backend in (PollyBackend, PollyTaskBackend, EspeakBackend,
+                                                SilenceBackend)}
+
+
+def create_backend(builder):
+    try:
+        return BACKENDS[builder.ssml_tts_backend](builder)
+    except KeyError:
+        raise ConfigError('unknown ssml_tts_backend: %r (%s)' % (
+            builder.ssml_tts_backend, ', '.join(sorted(BACKENDS))))
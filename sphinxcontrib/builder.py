@@ -1,4 +1,3 @@
-
 # -*- coding: utf-8 -*-
 """
     sphinxcontrib.ssmlbuilder
@@ -10,23 +9,50 @@
     :license: BSD, see LICENSE.txt for details.
 """
 
-from docutils.io import StringOutput
 from sphinx.builders import Builder
-from .writer import SSMLWriter
-from .throttling import exectasks
-from sphinx.util.osutil import SEP, os_path, relative_uri, ensuredir, \
-    movefile, copyfile
-from sphinx import addnodes
+from sphinx.environment import BuildEnvironment
+from .writer import SSMLWriter, ssml_wrapper
+from . import mp3
+from .cache import CacheIndex, CACHE_KEY_VERSION
+from .backends import create_backend
+from .remotecache import create_remote_cache
+from .chunker import MAX_REQUEST_CHARACTERS, billed_characters
+from .metrics import Metrics, get_logger
+from .synthesis import (SynthesisEngine, BatchSynthesisEngine, SynthesisJob,
+                        BackgroundSynthesizer)
+from sphinx.util.osutil import SEP, ensuredir
+from sphinx.util.build_phase import BuildPhase
+from sphinx.util.parallel import ParallelTasks, make_chunks
+import concurrent.futures
 import os
 from os import path
 import codecs
 import json
 import subprocess
 from fnmatch import fnmatch
-from boto3 import Session
-from botocore.exceptions import BotoCoreError, ClientError
 import datetime
+import hashlib
+import inspect
 import re
+import time
+
+
+logger = get_logger(__name__)
+
+# docname -> fragment hashes, sequence and title of every document
+FRAGMENT_MANIFEST = '_fragments.json'
+
+# docname -> digest of the fragment sequence and tags of each assembled MP3 file
+OUTPUT_MANIFEST = '_outputs.json'
+
+# Sphinx 7.3+ resolves doctrees with the tags of the builder
+RESOLVE_WITH_TAGS = 'tags' in inspect.signature(BuildEnvironment.get_and_resolve_doctree).parameters
+
+# timers and counters of the last build
+BUILD_REPORT = '_report.json'
+
+# fragments that the build would synthesize (ssml_polly_plan_only)
+SYNTHESIS_PLAN = '_plan.json'
 
 
 class SSMLBuilder(Builder):
@@ -46,6 +72,40 @@ class SSMLBuilder(Builder):
     ssml_polly_aws_profile = ''
     ssml_polly_aws_voiceid = 'Joanna'
     ssml_polly_apply_docnames = ''
+    ssml_polly_rate_limit = 8
+    ssml_polly_rate_burst = 10
+    ssml_polly_concurrency = 4
+    ssml_polly_max_concurrency = 16
+    ssml_polly_max_retries = 8
+    ssml_polly_backoff_base = 0.5
+    ssml_polly_backoff_max = 20.0
+    ssml_polly_endpoint_url = None
+    ssml_polly_engine = 'standard'
+    ssml_polly_sample_rate = None
+    ssml_polly_synthesize_while_writing = True
+    ssml_assembly_workers = None
+    ssml_assembler = 'builtin'
+    ssml_polly_text_limits = {'standard': 3000, 'neural': 3000}
+    ssml_fragment_boundaries = 'content'
+    ssml_polly_plan_only = False
+    ssml_polly_character_budget = None
+    ssml_tts_backend = 'polly'
+    ssml_tts_workers = None
+    ssml_polly_task_bucket = None
+    ssml_polly_task_prefix = 'ssmlbuilder/'
+    ssml_polly_s3_endpoint_url = None
+    ssml_polly_task_characters = 100000
+    ssml_polly_shards = None
+    ssml_cache_dir = None
+    ssml_cache_max_size = None
+    ssml_cache_max_age = 30
+    ssml_remote_cache = None
+    ssml_remote_cache_endpoint_url = None
+    ssml_remote_cache_workers = 8
+    synthesizer = None
+    synthesis_pid = None
+    shard_report = None
+    cache_index = None
 
     def init(self):
         """Load necessary templates and perform initialization."""
@@ -67,7 +127,79 @@ class SSMLBuilder(Builder):
             self.ssml_polly_aws_profile = self.config.ssml_polly_aws_profile
         if self.config.ssml_polly_aws_voiceid is not None:
             self.ssml_polly_aws_voiceid = self.config.ssml_polly_aws_voiceid
-        
+        for key in ('ssml_polly_rate_limit', 'ssml_polly_concurrency',
+                    'ssml_polly_max_concurrency', 'ssml_polly_max_retries',
+                    'ssml_polly_backoff_base', 'ssml_polly_backoff_max',
+                    'ssml_polly_endpoint_url', 'ssml_polly_engine', 'ssml_polly_sample_rate',
+                    'ssml_polly_synthesize_while_writing', 'ssml_assembly_workers',
+                    'ssml_assembler', 'ssml_polly_text_limits', 'ssml_fragment_boundaries',
+                    'ssml_polly_plan_only', 'ssml_polly_character_budget',
+                    'ssml_tts_backend', 'ssml_tts_workers', 'ssml_polly_task_bucket',
+                    'ssml_polly_task_prefix', 'ssml_polly_s3_endpoint_url',
+                    'ssml_polly_task_characters', 'ssml_polly_shards', 'ssml_cache_dir',
+                    'ssml_cache_max_size', 'ssml_remote_cache',
+                    'ssml_remote_cache_endpoint_url', 'ssml_remote_cache_workers'):
+            if getattr(self.config, key) is not None:
+                setattr(self, key, getattr(self.config, key))
+        # None is a value of its own for these settings
+        for key in ('ssml_polly_rate_burst', 'ssml_cache_max_age'):
+            setattr(self, key, getattr(self.config, key))
+        # -D gives strings for the settings of None default
+        for key, cast in (('ssml_polly_character_budget', int), ('ssml_cache_max_size', int),
+                          ('ssml_cache_max_age', float)):
+            if getattr(self, key) is not None:
+                setattr(self, key, cast(getattr(self, key)))
+        # everything that affects the audio except the SSML itself.
+        # it is a part of the fragment cache key.
+        self.synthesis_params = {"voice": self.ssml_polly_aws_voiceid,
+                                 "language": self.ssml_language,
+                                 "engine": self.ssml_polly_engine,
+                                 "format": "mp3",
+                                 "sample_rate": self.ssml_polly_sample_rate}
+        self.backend = create_backend(self)
+        self.remote_cache = create_remote_cache(self)
+        self.synthesis_params.update(self.backend.params)
+        # billed characters per fragment
+        self.fragment_limit = self.ssml_polly_text_limits.get(self.ssml_polly_engine, 3000)
+        # Polly's request limit applies to the whole document including the wrapper
+        head, tail = ssml_wrapper(self)
+        self.fragment_max_request = MAX_REQUEST_CHARACTERS - len(head) - len(tail)
+        # average characters between content-defined fragment boundaries
+        if self.ssml_fragment_boundaries == 'content':
+            self.fragment_anchor = self.fragment_limit // 2
+        else:
+            self.fragment_anchor = None
+        # settings that change the resulting SSML
+        settings = {"params": self.synthesis_params,
+                    "fragment_limit": self.fragment_limit,
+                    "fragment_anchor": self.fragment_anchor,
+                    "fragment_max_request": self.fragment_max_request,
+                    "version": CACHE_KEY_VERSION,
+                    "skip_block": self.ssml_skip_block,
+                    "break_around_section_title": self.ssml_break_around_section_title,
+                    "break_after_paragraph": self.ssml_break_after_paragraph,
+                    "emphasis_section_title": self.ssml_emphasis_section_title,
+                    "paragraph_speed": self.ssml_paragraph_speed}
+        self.settings_digest = hashlib.sha1(
+            json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+        self._source_digests = {}
+        self.metrics = Metrics()
+        self.build_start = time.time()
+        # docname -> {"hashes": ..., "sequence": ..., "title": ..., "digest": ...}
+        with self.metrics.timer("manifest_load"):
+            self.fragments = self.load_fragment_manifest()
+        # fragment files of the last build. files that are not referenced anymore are removed
+        self.previous_fragment_files = self.fragment_files(self.fragments)
+        self.writing_docnames = set()
+        self.written_docnames = set()
+        # workpath
+        self.outputpath = path.join(path.abspath("."), self.ssml_polly_audio_output_folder)
+        if self.ssml_cache_dir:
+            # shared by projects and branches
+            self.workdirpath = path.abspath(path.expanduser(self.ssml_cache_dir))
+        else:
+            self.workdirpath = path.join(self.outputpath, "_temp")
+
         def run_exec_polly(app, exception):
             self.exec_polly()
         self.app.connect("build-finished", run_exec_polly)
@@ -75,35 +207,177 @@ class SSMLBuilder(Builder):
     def file_transform(self, docname):
         return docname + self.file_list_suffix
 
+    def source_digest(self, docname):
+        """Digest of the source, its dependencies and the settings that change the output.
+
+        Unlike mtime, it is stable over ``git checkout`` and CI cache restores.
+        """
+        digest = self._source_digests.get(docname)
+        if digest is not None:
+            return digest
+        h = hashlib.sha1(self.settings_digest.encode('utf-8'))
+        filenames = [self.env.doc2path(docname)]
+        filenames += sorted(path.join(self.srcdir, dep)
+                            for dep in self.env.dependencies.get(docname, ()))
+        for filename in filenames:
+            # relative with "/", so that the digest doesn't depend on where and on which
+            # OS the project is checked out
+            name = path.relpath(filename, self.srcdir).replace(path.sep, SEP)
+            h.update(name.encode('utf-8', 'surrogateescape') + b'\0')
+            try:
+                with open(filename, 'rb') as f:
+                    for chunk in iter(lambda: f.read(64 * 1024), b''):
+                        h.update(chunk)
+            except (IOError, OSError):
+                h.update(b'\0missing\0')
+        digest = self._source_digests[docname] = h.hexdigest()
+        return digest
+
+    def is_unchanged(self, docname):
+        previous = self.fragments.get(docname)
+        return previous is not None and previous.get("digest") == self.source_digest(docname)
+
     def get_outdated_docs(self):
         for docname in self.env.found_docs:
             if docname not in self.env.all_docs:
                 yield docname
                 continue
-            targetname = path.join(self.outdir, self.file_transform(docname))
-            try:
-                targetmtime = path.getmtime(targetname)
-            except Exception:
-                targetmtime = 0
-            try:
-                srcmtime = path.getmtime(self.env.doc2path(docname))
-                if srcmtime > targetmtime:
-                    yield docname
-            except EnvironmentError:
+            if not path.exists(self.env.doc2path(docname)):
                 # source doesn't exist anymore
-                pass
+                continue
+            if not self.is_unchanged(docname):
+                yield docname
 
     def get_target_uri(self, docname, typ=None):
         return ''
 
     def prepare_writing(self, docnames):
         self.writer = SSMLWriter(self)
+        self.writing_docnames = set(docnames)
+        # the plan, the budget and the remote cache need all fragments before the first request.
+        # the synthesis starts with the first fragment to synthesize
+        if self.ssml_polly_synthesize_while_writing and self.backend.incremental and \
+                not self.ssml_polly_plan_only and self.ssml_polly_character_budget is None and \
+                self.remote_cache is None:
+            self.synthesis_pid = os.getpid()
+
+    def create_synthesis_engine(self):
+        backend = self.backend
+
+        def progress(job, done, total):
+            logger.info(f"{backend.name} synthesis for {job.name} ({done}/{total})")
+
+        if backend.batch_size > 1:
+            return BatchSynthesisEngine(backend.create_shards(), progress, self.cache_index,
+                                        metrics=self.metrics, batch_size=backend.batch_size,
+                                        batch_characters=backend.batch_characters)
+        return SynthesisEngine(backend.create_shards(), progress, self.cache_index,
+                               backend.split, self.metrics)
+
+    def open_cache_index(self):
+        if self.cache_index is None:
+            ensuredir(self.workdirpath)
+            self.cache_index = CacheIndex(self.workdirpath)
+        return self.cache_index
+
+    def start_synthesis(self):
+        """Start background synthesis. Fragments are queued as soon as they are written."""
+        self.synthesis_pid = os.getpid()
+        self.open_cache_index()
+        self.synthesizer = BackgroundSynthesizer(self.create_synthesis_engine())
+
+    def fragment_ready(self, docname, key, filename, ssml=None):
+        """Called for each written SSML fragment.
+
+        Fragments of the parallel write workers are passed without ``ssml``
+        after their chunk is merged, and the SSML is read from ``filename``.
+        """
+        # forked worker processes don't have the synthesis thread
+        if os.getpid() != self.synthesis_pid:
+            return
+        if not fnmatch(docname, self.config.ssml_polly_apply_docnames):
+            return
+        if self.synthesizer is not None and key in self.synthesizer.submitted:
+            return
+        if self.open_cache_index().verify([key]):
+            return
+        if self.synthesizer is None:
+            self.start_synthesis()
+        if ssml is None:
+            with open(path.join(self.outdir, filename)) as f:
+                ssml = f.read()
+        self.synthesizer.submit(SynthesisJob(key, ssml, self.cache_index.filepath(key), filename))
+
+    def set_phase(self, phase):
+        # Sphinx 1.x keeps the build phase in the application
+        if hasattr(Builder, 'phase'):
+            self.phase = phase
+        else:
+            self.app.phase = phase
+
+    def resolve_doctree(self, docname):
+        if RESOLVE_WITH_TAGS:
+            return self.env.get_and_resolve_doctree(docname, self, tags=self.tags)
+        return self.env.get_and_resolve_doctree(docname, self)
+
+    def _write_parallel(self, docnames, nproc):
+        """Same as :class:`~sphinx.builders.Builder`'s, but the worker processes
+        send the fragment lists of their documents back to the main process.
+
+        The results are merged into :attr:`fragments` and their fragments are
+        queued for synthesis as each chunk is finished.
+        """
+        def write_process(docs):
+            # it runs in a forked process: record only the metrics of this chunk
+            self.set_phase(BuildPhase.WRITING)
+            self.metrics = Metrics()
+            results = {}
+            for docname, doctree in docs:
+                self.write_doc(docname, doctree)
+                results[docname] = self.fragments[docname]
+            return results, self.metrics.state()
+
+        def on_chunk_done(args, result):
+            results, metrics = result
+            self.metrics.merge(metrics)
+            for docname, destination in results.items():
+                self.fragments[docname] = destination
+                self.written_docnames.add(docname)
+                for key in destination["sequence"]:
+                    self.fragment_ready(docname, key, destination["hashes"][key])
+            done[0] += 1
+            logger.info(f"writing output... ({done[0]}/{len(chunks)} chunks)")
+
+        # the first document is written in the main process like Sphinx does
+        firstname, docnames = docnames[0], docnames[1:]
+        self.set_phase(BuildPhase.RESOLVING)
+        doctree = self.resolve_doctree(firstname)
+        self.set_phase(BuildPhase.WRITING)
+        self.write_doc_serialized(firstname, doctree)
+        self.write_doc(firstname, doctree)
+
+        tasks = ParallelTasks(nproc)
+        chunks = make_chunks(docnames, nproc)
+        done = [0]
+        self.set_phase(BuildPhase.RESOLVING)
+        for chunk in chunks:
+            arg = []
+            for docname in chunk:
+                doctree = self.resolve_doctree(docname)
+                self.write_doc_serialized(docname, doctree)
+                arg.append((docname, doctree))
+            tasks.add_task(write_process, arg, on_chunk_done)
+        tasks.join()
 
     def write_doc(self, docname, doctree):
-        destination = {"hashes": {}, "sequence": [], "title": ""}
         outfilename = path.join(self.outdir, self.file_transform(docname))
+        destination = {"hashes": {}, "sequence": [], "title": "",
+                       "digest": self.source_digest(docname)}
         ensuredir(path.dirname(outfilename))
         self.writer.write(doctree, destination, docname, path.join(self.outdir, docname))
+        self.fragments[docname] = destination
+        self.written_docnames.add(docname)
+        self.metrics.count("documents_written")
         try:
             f = codecs.open(outfilename, 'w', 'utf-8')
             try:
@@ -111,94 +385,334 @@ class SSMLBuilder(Builder):
             finally:
                 f.close()
         except (IOError, OSError) as err:
-            self.warn("error writing file %s: %s" % (outfilename, err))
-
-    def sort_docnames(self):
-        result = [self.config.master_doc]
-        self._sort_docnames(self.config.master_doc, result)
-        return result
-
-    def _sort_docnames(self, docname, traversed):
-        tree = self.env.get_doctree(docname)
-        for toctreenode in tree.traverse(addnodes.toctree):
-            includefiles = map(str, toctreenode['includefiles'])
-            for includefile in includefiles:
-                 if includefile not in traversed:
-                     try:
-                         traversed.append(includefile)
-                         self._sort_docnames(includefile, traversed)
-                     except Exception:
-                         pass
+            logger.warning("error writing file %s: %s" % (outfilename, err))
 
-    def exec_polly(self):
-        print("ssml_polly_aws_profile: ", self.ssml_polly_aws_profile)
-        print("ssml_polly_apply_docnames: ", self.config.ssml_polly_apply_docnames)
-        print("audio output folder: ", self.ssml_polly_audio_output_folder)
-        print("ssml_polly_aws_voiceid: ", self.ssml_polly_aws_voiceid)
+    def load_fragment_manifest(self):
+        try:
+            with open(path.join(self.outdir, FRAGMENT_MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def fragment_files(self, fragments):
+        return {filename for d in fragments.values() for filename in d["hashes"].values()}
+
+    def prune_fragment_files(self, removed_docnames):
+        """Remove ``.ssml`` files of the removed sections and ``.json`` files of the removed documents."""
+        stale = self.previous_fragment_files - self.fragment_files(self.fragments)
+        stale.update(self.file_transform(docname) for docname in removed_docnames)
+        for filename in stale:
+            try:
+                os.remove(path.join(self.outdir, filename))
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                logger.warning("error removing file %s: %s" % (filename, err))
+        self.previous_fragment_files = self.fragment_files(self.fragments)
+
+    def update_fragment_manifest(self):
+        """Merge per-document results into the build-wide fragment manifest and save it.
 
-        # config path
+        Documents written in this build, including the ones of parallel
+        worker processes, are already in :attr:`fragments`. Only documents
+        missing in the manifest are read from their ``.json`` files.
+        """
+        removed_docnames = [docname for docname in self.fragments
+                            if docname not in self.env.found_docs]
+        for docname in removed_docnames:
+            del self.fragments[docname]
+        for docname in self.env.found_docs:
+            if docname in self.written_docnames:
+                continue
+            if docname in self.fragments and docname not in self.writing_docnames:
+                continue
+            setting = path.join(self.outdir, self.file_transform(docname))
+            try:
+                with open(setting) as f:
+                    self.fragments[docname] = json.load(f)
+            except (IOError, OSError, ValueError) as err:
+                logger.warning("error reading file %s: %s" % (setting, err))
+        filename = path.join(self.outdir, FRAGMENT_MANIFEST)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.fragments, f, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+        self.prune_fragment_files(removed_docnames)
+
+    def track_numbers(self):
+        """Return ``{docname: track number}`` in the reading order of the toctrees.
+
+        It is a depth-first walk of ``env.toctree_includes`` from the master
+        document, so no doctree is loaded. Documents outside the toctrees
+        follow in name order.
+        """
+        includes = self.env.toctree_includes
+        master = self.config.master_doc
+        tracks = {master: 1}
+        stack = [iter(includes.get(master, ()))]
+        while stack:
+            for docname in stack[-1]:
+                if docname not in tracks:
+                    tracks[docname] = len(tracks) + 1
+                    stack.append(iter(includes.get(docname, ())))
+                    break
+            else:
+                stack.pop()
+        for docname in sorted(self.env.found_docs - set(tracks)):
+            tracks[docname] = len(tracks) + 1
+        return tracks
+
+    def output_digest(self, sequence, metadata):
+        """Digest of everything that makes up ``{docname}.mp3``."""
+        source = json.dumps({"sequence": sequence, "metadata": metadata,
+                             "assembler": self.ssml_assembler}, sort_keys=True)
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def load_output_manifest(self):
+        try:
+            with open(path.join(self.outputpath, OUTPUT_MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_output_manifest(self, manifest):
+        filename = path.join(self.outputpath, OUTPUT_MANIFEST)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+
+    def concat_fragments(self, docname, sequence, metadata):
+        """Join the fragments of ``sequence`` into ``{docname}.mp3``."""
+        outfilename = path.join(self.outputpath, f"{docname}.mp3")
+        ensuredir(path.dirname(outfilename))
+        if self.ssml_assembler == 'ffmpeg':
+            self.concat_fragments_by_ffmpeg(sequence, metadata, outfilename)
+        else:
+            mp3.concatenate([path.join(self.workdirpath, hashkey + '.mp3') for hashkey in sequence],
+                            outfilename, metadata)
+
+    def concat_fragments_by_ffmpeg(self, sequence, metadata, outfilename):
+        sources = [hashkey + '.mp3' for hashkey in sequence]
+        args = ['ffmpeg', "-y", "-loglevel", "error",
+                "-i", "concat:" + "|".join(sources), "-c", "copy"]
+        for key, value in metadata.items():
+            args += ['-metadata', f'{key}={value}']
+        args.append(outfilename)
+        with self.metrics.timer("ffmpeg"):
+            p = subprocess.run(args, shell=False, cwd=self.workdirpath,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise RuntimeError("ffmpeg exited with %d: %s" % (
+                p.returncode, p.stderr.decode('utf-8', 'replace').strip()))
+
+    def assemble(self, jobs):
+        """Run :meth:`concat_fragments` for ``(docname, sequence, metadata)`` jobs in parallel.
+
+        Returns ``{docname: exception}`` of the failed documents.
+        """
+        failures = {}
+        if not jobs:
+            return failures
+        workers = self.ssml_assembly_workers or os.cpu_count() or 1
+        # each job waits for its own ffmpeg process or copies in the kernel,
+        # so threads are enough to keep the cores busy
+        with concurrent.futures.ThreadPoolExecutor(min(workers, len(jobs))) as executor:
+            futures = {executor.submit(self.concat_fragments, *job): job[0] for job in jobs}
+            for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                docname = futures[future]
+                try:
+                    future.result()
+                except Exception as err:
+                    failures[docname] = err
+                logger.info(f"concatinating MP3 fragments: {docname}.mp3 ({done}/{len(jobs)})")
+        self.metrics.count("documents_assembled", len(jobs) - len(failures))
+        self.metrics.count("assembly_failures", len(failures))
+        return failures
+
+    def write_build_report(self, targets):
+        """Save the metrics as ``_report.json`` and emit ``ssml-build-report`` event."""
+        report = {"started": datetime.datetime.fromtimestamp(self.build_start).isoformat(),
+                  "duration": time.time() - self.build_start,
+                  "documents": len(self.fragments),
+                  "targets": targets,
+                  "shards": self.shard_report or []}
+        report.update(self.metrics.report())
+        filename = path.join(self.outputpath, BUILD_REPORT)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+        self.app.emit('ssml-build-report', report)
+        counters = report["counters"]
+        logger.info("polly: %d API calls, %d retries, %d billed characters, cache hit ratio %s" % (
+            counters.get("api_calls", 0), counters.get("retries", 0),
+            counters.get("billed_characters", 0),
+            "-" if report["cache_hit_ratio"] is None else "%.1f%%" % (report["cache_hit_ratio"] * 100)))
+        return report
+
+    def plan_synthesis(self, index, submitted):
+        """Compare the fragment manifest with the cache.
+
+        Returns ``(hash2path, targets, allneededhash, must_convert, must_remove)``.
+        Fragments in ``submitted`` are already being synthesized and not in ``must_convert``.
+        """
         apply_docname = self.config.ssml_polly_apply_docnames
-    
-        # workpath
-        outputpath = path.join(path.abspath("."), self.ssml_polly_audio_output_folder)
-        workdirpath = path.join(outputpath, "_temp")
-        ensuredir(workdirpath)
-    
-        # read_config
-        allhash = set()
+        with self.metrics.timer("manifest_update"):
+            self.update_fragment_manifest()
         hash2path = {}
         allneededhash = set()
         targets = []
-        for docname in self.env.found_docs:
-            setting = path.join(self.outdir, self.file_transform(docname))
-            f = open(setting)
-            d = json.load(f)
-            for hashname in d["hashes"]:
-                allhash.add(hashname)
+        for docname, d in self.fragments.items():
             hash2path.update(d["hashes"])
             if fnmatch(docname, apply_docname):
                 targets.append({"docname": docname, "sequence": d["sequence"], "title": d["title"]})
-                for hashname in d["hashes"]:
-                    allneededhash.add(hashname)
-        # read existing path
-        existinghash = set()
-        for mp3file in os.listdir(workdirpath):
-            hashpart, ext = path.splitext(mp3file)
-            if ext == '.mp3':
-                existinghash.add(hashpart)
-        must_remove = existinghash - allhash
-        must_convert = allneededhash - existinghash
-        #print("targets", targets)
-        #print("must_remove:", must_remove)
-        #print("must_convert:", must_convert)
-
-        # exec polly
-        session = Session(profile_name=self.ssml_polly_aws_profile)
-        polly = session.client("polly")
-        task_count = 1
-
-        def exec_polly(hashkey):
-            nonlocal task_count
-            print(f"polly.synthesize_speech for {hash2path[hashkey]} ({task_count}/{len(must_convert)})")
-            task_count+=1
-            ssmlpath = path.join(self.outdir, hash2path[hashkey])
-            ssmlsource = open(ssmlpath).read()
-            try:
-                # Request speech synthesis
-                response = polly.synthesize_speech(Text=ssmlsource,
-                                                   VoiceId=self.ssml_polly_aws_voiceid,
-                                                   TextType='ssml',
-                                                   OutputFormat="mp3")
-            except (BotoCoreError, ClientError) as err:
-                # The service returned an error
-                raise HTTPStatusError(HTTP_STATUS["INTERNAL_SERVER_ERROR"],
-                                      str(err))
-
-            mp3file = open(path.join(workdirpath, f"{hashkey}.mp3"), "wb")
-            mp3file.write(response.get("AudioStream").read())
-            mp3file.close()
-
-        exectasks(10, must_convert, exec_polly)
+                allneededhash.update(d["hashes"])
+        # fragments of this project are never evicted
+        must_remove = index.eviction_candidates(hash2path, self.ssml_cache_max_size,
+                                                self.ssml_cache_max_age)
+        must_convert = allneededhash - submitted
+        must_convert -= index.verify(must_convert)
+        return hash2path, targets, allneededhash, must_convert, must_remove
+
+    def fetch_remote(self, index, keys):
+        """Download ``keys`` that the remote cache has. Returns the keys still to synthesize.
+
+        In plan mode, nothing is downloaded.
+        """
+        remote = self.remote_cache
+        if remote is None or not keys:
+            return keys
+        try:
+            with self.metrics.timer("remote_lookup"):
+                found = remote.exists(keys)
+        except Exception as err:
+            logger.warning(f"remote cache lookup failed: {err}")
+            return keys
+        self.metrics.count("remote_hits", len(found))
+        self.metrics.count("remote_misses", len(keys) - len(found))
+        if self.ssml_polly_plan_only:
+            return keys - found
+        with self.metrics.timer("remote_prefetch"):
+            fetched, failures = remote.prefetch(index, found)
+        for hashkey, err in failures.items():
+            logger.warning(f"remote cache download failed for {hashkey}: {err}")
+        logger.info(f"remote cache: {len(fetched)} of {len(keys)} fragments downloaded")
+        return keys - fetched
+
+    def upload_remote(self, index, keys):
+        remote = self.remote_cache
+        if remote is None or not keys:
+            return
+        with self.metrics.timer("remote_upload"):
+            uploaded, failures = remote.upload(index, keys)
+        self.metrics.count("remote_uploads", len(uploaded))
+        for hashkey, err in failures.items():
+            logger.warning(f"remote cache upload failed for {hashkey}: {err}")
+
+    def billed_characters(self, ssml):
+        """Characters billed for the synthesis of ``ssml`` by the backend."""
+        return billed_characters(ssml) * self.backend.billed_passes
+
+    def write_plan(self, hash2path, targets, sources, must_remove):
+        """Save ``_plan.json``: fragments to synthesize, billed characters and estimated time."""
+        characters = {hashkey: self.billed_characters(ssml) for hashkey, ssml in sources.items()}
+        documents = {}
+        for target in targets:
+            keys = set(target["sequence"]) & set(sources)
+            if keys:
+                documents[target["docname"]] = {
+                    "fragments": len(keys),
+                    "characters": sum(characters[hashkey] for hashkey in keys)}
+        total = sum(characters.values())
+        rate = self.backend.rate_limit
+        budget = self.ssml_polly_character_budget
+        plan = {"requests": len(sources),
+                "characters": total,
+                # the token bucket is the lower bound of the synthesis time
+                "estimated_seconds": len(sources) / rate if rate else None,
+                "rate_limit": rate,
+                "backend": self.backend.name,
+                "max_concurrency": self.backend.max_concurrency,
+                "character_budget": budget,
+                "within_budget": budget is None or total <= budget,
+                "evicted_fragments": len(must_remove),
+                "documents": documents,
+                "fragments": [{"key": hashkey, "file": hash2path[hashkey],
+                               "characters": characters[hashkey]}
+                              for hashkey in sorted(sources, key=lambda k: hash2path[k])]}
+        ensuredir(self.outputpath)
+        filename = path.join(self.outputpath, SYNTHESIS_PLAN)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(plan, f, indent=2, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+        estimate = "-" if plan["estimated_seconds"] is None else "%.0fs" % plan["estimated_seconds"]
+        logger.info(f"synthesis plan: {plan['requests']} requests, {total} characters, "
+                    f"at least {estimate} ({filename})")
+        return plan
+
+    def exec_polly(self):
+        logger.info("ssml_polly_aws_profile: %s" % self.ssml_polly_aws_profile)
+        logger.info("ssml_polly_apply_docnames: %s" % self.config.ssml_polly_apply_docnames)
+        logger.info("audio output folder: %s" % self.ssml_polly_audio_output_folder)
+        logger.info("ssml_polly_aws_voiceid: %s" % self.ssml_polly_aws_voiceid)
+
+        outputpath = self.outputpath
+        index = self.open_cache_index()
+        submitted = self.synthesizer.submitted if self.synthesizer else set()
+        hash2path, targets, allneededhash, must_convert, must_remove = \
+            self.plan_synthesis(index, submitted)
+        must_convert = self.fetch_remote(index, must_convert)
+        sources = {}
+        for hashkey in must_convert:
+            with open(path.join(self.outdir, hash2path[hashkey])) as f:
+                sources[hashkey] = f.read()
+
+        if self.ssml_polly_plan_only:
+            self.write_plan(hash2path, targets, sources, must_remove)
+            index.close()
+            self.cache_index = None
+            return
+
+        # fragments that are not synthesized in this build
+        missing = set()
+        budget = self.ssml_polly_character_budget
+        if budget is not None:
+            characters = sum(self.billed_characters(ssml) for ssml in sources.values())
+            if characters > budget:
+                logger.warning(f"synthesis is aborted: {characters} characters of {len(sources)} "
+                               f"fragments exceed ssml_polly_character_budget ({budget})")
+                missing.update(sources)
+                sources = {}
+
+        failed_last_time = set(sources) & set(index.failed())
+        if failed_last_time:
+            logger.info(f"retry {len(failed_last_time)} fragments that failed in the last build")
+
+        # exec polly. the clients are created only if there is something to synthesize
+        if self.synthesizer is None and sources:
+            self.start_synthesis()
+        synthesizer = self.synthesizer
+        results, failures = {}, {}
+        if synthesizer is not None:
+            for hashkey, ssmlsource in sources.items():
+                synthesizer.submit(SynthesisJob(hashkey, ssmlsource, index.filepath(hashkey),
+                                                hash2path[hashkey]))
+            submitted = synthesizer.submitted
+        misses = allneededhash & (submitted | missing)
+        self.metrics.count("cache_misses", len(misses))
+        self.metrics.count("cache_hits", len(allneededhash) - len(misses))
+        if synthesizer is not None:
+            with self.metrics.timer("synthesis"):
+                results, failures = synthesizer.join()
+            self.shard_report = [shard.report() for shard in synthesizer.engine.shards]
+            self.synthesizer = None
+            if synthesizer.error is not None:
+                logger.warning(f"{self.backend.name} synthesis stopped: {synthesizer.error}")
+        for hashkey, err in failures.items():
+            logger.warning("%s synthesis failed for %s: %s" % (
+                self.backend.name, hash2path.get(hashkey, hashkey), err))
+        # anything neither synthesized nor in the cache can't be concatenated
+        unsynthesized = allneededhash - set(results)
+        missing = unsynthesized - index.verify(unsynthesized)
+        self.upload_remote(index, set(results))
 
         # metadata
         album = self.config.project
@@ -208,33 +722,46 @@ class SSMLBuilder(Builder):
         if match:
             year = match.group(1)
             author = match.group(2)
-        document_order = self.sort_docnames()
+        tracks = self.track_numbers()
 
         # concat mp3 fragments
-        task = 1 
+        manifest = self.load_output_manifest()
+        digests = {}
+        jobs = []
         for target in targets:
             docname = target['docname']
-            title = target['title']
-            track = document_order.index(docname) + 1
-
-            print(f"concatinating MP3 fragments: {docname}.mp3 ({task}/{len(targets)})")
-            task+=1
-            sources = [hashkey + '.mp3' for hashkey in target['sequence']]
-            outfilename = path.join(outputpath, f"{docname}.mp3")
-            ensuredir(path.dirname(outfilename))
-
-            args = ['ffmpeg', "-y", "-i", "concat:" + "|".join(sources), "-c", "copy",
-                    '-metadata', f'album={album}',
-                    '-metadata', f'author={author}',
-                    '-metadata', f'title={title}',
-                    '-metadata', f'track={track}',
-                    '-metadata', 'genre=Audio Book',
-                    '-metadata', f'year={year}',
-                    outfilename]
-            #print(args, workdirpath)
-            p = subprocess.Popen(args, shell=False, cwd=workdirpath)
-            p.wait()
-
-        # remove unused file
-        for hashkey in must_remove:
-            os.remove(path.join(workdirpath, hashkey + '.mp3'))
+            if any(hashkey in missing for hashkey in target['sequence']):
+                logger.warning(f"skip concatinating {docname}.mp3: some fragments are missing")
+                continue
+            metadata = {"album": album,
+                        "author": author,
+                        "title": target['title'],
+                        "track": tracks[docname],
+                        "genre": "Audio Book",
+                        "year": year}
+            digest = self.output_digest(target['sequence'], metadata)
+            if manifest.get(docname) == digest and \
+                    path.exists(path.join(outputpath, f"{docname}.mp3")):
+                continue
+            manifest.pop(docname, None)
+            digests[docname] = digest
+            jobs.append((docname, target['sequence'], metadata))
+        logger.info(f"concatinating MP3 fragments: {len(jobs)} of {len(targets)} documents are changed")
+        with self.metrics.timer("assembly"):
+            assembly_failures = self.assemble(jobs)
+        for docname, err in sorted(assembly_failures.items()):
+            logger.warning(f"concatinating {docname}.mp3 failed: {err}")
+            del digests[docname]
+        manifest.update(digests)
+        self.save_output_manifest(manifest)
+
+        # least recently used fragments over the budget
+        index.touch(allneededhash)
+        evicted = index.evict(hash2path, self.ssml_cache_max_size, self.ssml_cache_max_age)
+        if evicted is None:
+            logger.info("cache eviction is skipped: the cache is used by other builds")
+        else:
+            self.metrics.count("cache_evictions", len(evicted))
+        index.close()
+        self.cache_index = None
+        self.write_build_report(len(targets))
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib.cache
+    ~~~~~~~~~~~~~~~~~~~
+
+    Synthesized audio fragment cache.
+
+    Fragments are stored as ``<key>.mp3``. The key covers everything that
+    changes the resulting audio (see :func:`synthesis_key`), and the
+    SQLite index keeps what the cache holds, so lookups are queries
+    instead of directory scans.
+
+    The index is also the synthesis journal. A fragment is registered only
+    after its file is completely written and renamed, in-flight and failed
+    requests are kept in the ``journal`` table, so an interrupted build
+    resumes from the fragments that are not completed yet.
+
+    A cache directory can be shared by projects, branches and concurrent
+    builds. Each build holds :class:`CacheLock` shared while it uses the
+    cache. Recovery of interrupted requests and eviction remove files that
+    another build may be using, so they run only when the lock can be taken
+    exclusively. Fragments are evicted least recently used first, down to
+    a size and age budget.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import functools
+import glob
+import hashlib
+import json
+import os
+from os import path
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+from . import mp3
+
+# bump it when the way to make audio changes
+CACHE_KEY_VERSION = 1
+
+INDEX_FILENAME = 'index.sqlite'
+INDEX_SCHEMA_VERSION = 1
+LOCK_FILENAME = 'lock'
+
+# seconds to wait for the database locked by another build
+BUSY_TIMEOUT = 60.0
+
+# SQLite's default limit of host parameters is 999
+QUERY_CHUNK = 500
+
+
+def synthesis_key(ssml, params):
+    """Return the cache key for the complete SSML document and synthesis ``params``.
+
+    ``params`` is a dict of the voice, language, engine, format and so on.
+    """
+    payload = json.dumps({'version': CACHE_KEY_VERSION, 'ssml': ssml, 'params': params},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def file_checksum(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        with self.lock:
+            return method(self, *args)
+    return wrapper
+
+
+def _chunks(items, size=QUERY_CHUNK):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class CacheLock:
+    """Inter-process lock of a cache directory.
+
+    Windows has no shared lock, so there builds that share a cache run
+    one at a time.
+    """
+    def __init__(self, directory):
+        self.file = open(path.join(directory, LOCK_FILENAME), 'a+b')
+        self.mode = None
+
+    def _lock(self, exclusive, blocking):
+        if fcntl is not None:
+            flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            try:
+                fcntl.flock(self.file.fileno(), flags | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return False
+            return True
+        if self.mode is not None:
+            return True
+        while True:
+            try:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.1)
+
+    def acquire(self):
+        """Take the lock shared, or exclusively if no other build holds it.
+
+        Returns ``True`` if it is exclusive.
+        """
+        if self._lock(True, False):
+            self.mode = 'exclusive'
+            return True
+        self._lock(False, True)
+        self.mode = 'shared'
+        return False
+
+    def try_exclusive(self):
+        if self.mode == 'exclusive' or self._lock(True, False):
+            self.mode = 'exclusive'
+            return True
+        return False
+
+    def share(self):
+        if fcntl is not None and self.mode == 'exclusive':
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_SH)
+            self.mode = 'shared'
+
+    def release(self):
+        if self.mode is not None:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.mode = None
+        self.file.close()
+
+
+class CacheIndex:
+    """SQLite index of the fragments in ``workdir``."""
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.dbpath = path.join(workdir, INDEX_FILENAME)
+        self.filelock = CacheLock(workdir)
+        alone = self.filelock.acquire()
+        created = not path.exists(self.dbpath)
+        # the connection is shared with the background synthesis thread
+        self.conn = sqlite3.connect(self.dbpath, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS fragments (
+                                 key TEXT PRIMARY KEY,
+                                 size INTEGER,
+                                 duration REAL,
+                                 last_used REAL,
+                                 checksum TEXT,
+                                 mtime REAL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS journal (
+                                 key TEXT PRIMARY KEY,
+                                 state TEXT,
+                                 tmppath TEXT,
+                                 error TEXT,
+                                 updated REAL)''')
+        self.conn.execute('PRAGMA user_version = %d' % INDEX_SCHEMA_VERSION)
+        if created:
+            self.rebuild()
+        if alone:
+            # in-flight requests of the other builds are not interrupted ones
+            self.recover()
+        self.conn.commit()
+        self.filelock.share()
+
+    def close(self):
+        self.conn.close()
+        self.filelock.release()
+
+    def filepath(self, key):
+        return path.join(self.workdir, key + '.mp3')
+
+    def rebuild(self):
+        """Import existing ``.mp3`` files. It runs once when the index is created."""
+        now = time.time()
+        for filename in os.listdir(self.workdir):
+            key, ext = path.splitext(filename)
+            if ext != '.mp3':
+                continue
+            filepath = path.join(self.workdir, filename)
+            stat = os.stat(filepath)
+            self.conn.execute('INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, stat.st_size, mp3.duration(filepath), now,
+                               file_checksum(filepath), stat.st_mtime))
+
+    def recover(self):
+        """Clean up the requests that were in flight when the last build was killed."""
+        rows = self.conn.execute("SELECT key, tmppath FROM journal WHERE state = 'inflight'").fetchall()
+        for key, tmppath in rows:
+            if not tmppath:
+                continue
+            # with the pieces of a fragment that was being split
+            for filepath in [tmppath] + glob.glob(glob.escape(tmppath) + '.*'):
+                try:
+                    os.remove(filepath)
+                except FileNotFoundError:
+                    pass
+        self.conn.execute("DELETE FROM journal WHERE state = 'inflight'")
+
+    @_locked
+    def existing(self, keys):
+        """Return the subset of ``keys`` that the cache holds."""
+        result = set()
+        for chunk in _chunks(keys):
+            query = 'SELECT key FROM fragments WHERE key IN (%s)' % ','.join('?' * len(chunk))
+            result.update(row[0] for row in self.conn.execute(query, chunk))
+        return result
+
+    @_locked
+    def verify(self, keys):
+        """Drop the entries of ``keys`` whose file is missing or changed.
+
+        A file of the right size is checked against its checksum only if its
+        mtime changed (e.g. the cache is restored by CI), so an unchanged
+        cache costs one ``stat`` per key. Returns the keys that are still valid.
+        """
+        valid = set()
+        broken = []
+        touched = []
+        for chunk in _chunks(keys):
+            query = ('SELECT key, size, checksum, mtime FROM fragments WHERE key IN (%s)'
+                     % ','.join('?' * len(chunk)))
+            for key, size, checksum, mtime in self.conn.execute(query, chunk).fetchall():
+                filepath = self.filepath(key)
+                try:
+                    stat = os.stat(filepath)
+                    if stat.st_size == size:
+                        if stat.st_mtime == mtime:
+                            valid.add(key)
+                            continue
+                        if file_checksum(filepath) == checksum:
+                            valid.add(key)
+                            touched.append((stat.st_mtime, key))
+                            continue
+                except OSError:
+                    pass
+                broken.append(key)
+        if touched:
+            self.conn.executemany('UPDATE fragments SET mtime = ? WHERE key = ?', touched)
+            self.conn.commit()
+        if broken:
+            self.remove(broken)
+        return valid
+
+    @_locked
+    def eviction_candidates(self, protected, max_size=None, max_age=None):
+        """Return the keys to evict, except ``protected``, least recently used first.
+
+        Fragments unused for ``max_age`` days are evicted, and then more
+        until the total size is ``max_size`` bytes or less.
+        """
+        protected = set(protected)
+        rows = self.conn.execute('SELECT key, size, last_used FROM fragments '
+                                 'ORDER BY last_used').fetchall()
+        total = sum(size or 0 for key, size, last_used in rows)
+        expiry = time.time() - max_age * 86400 if max_age is not None else None
+        result = []
+        for key, size, last_used in rows:
+            if key in protected:
+                continue
+            if (expiry is not None and (last_used or 0) < expiry) or \
+                    (max_size is not None and total > max_size):
+                result.append(key)
+                total -= size or 0
+        return result
+
+    def evict(self, protected, max_size=None, max_age=None):
+        """Remove :meth:`eviction_candidates`. Returns the removed keys,
+        or ``None`` if another build uses the cache.
+        """
+        if not self.filelock.try_exclusive():
+            return None
+        try:
+            keys = self.eviction_candidates(protected, max_size, max_age)
+            self.remove(keys)
+            return keys
+        finally:
+            self.filelock.share()
+
+    @_locked
+    def start(self, key, tmppath):
+        """Record that the fragment of ``key`` is being written to ``tmppath``."""
+        self.conn.execute('INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)',
+                          (key, 'inflight', tmppath, None, time.time()))
+        self.conn.commit()
+
+    def complete(self, key, size, checksum):
+        """Register the fragment file of ``key`` that is completely written."""
+        filepath = self.filepath(key)
+        duration = mp3.duration(filepath)
+        mtime = os.stat(filepath).st_mtime
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, size, duration, time.time(), checksum, mtime))
+            self.conn.execute('DELETE FROM journal WHERE key = ?', (key,))
+            self.conn.commit()
+
+    @_locked
+    def fail(self, key, error):
+        self.conn.execute('INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)',
+                          (key, 'failed', None, error, time.time()))
+        self.conn.commit()
+
+    @_locked
+    def failed(self):
+        """Return ``{key: error}`` of the fragments that failed last time."""
+        return dict(self.conn.execute("SELECT key, error FROM journal WHERE state = 'failed'"))
+
+    @_locked
+    def touch(self, keys):
+        now = time.time()
+        for chunk in _chunks(keys):
+            query = 'UPDATE fragments SET last_used = ? WHERE key IN (%s)' % ','.join('?' * len(chunk))
+            self.conn.execute(query, [now] + chunk)
+        self.conn.commit()
+
+    @_locked
+    def remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.filepath(key))
+            except FileNotFoundError:
+                pass
+        for chunk in _chunks(keys):
+            marks = ','.join('?' * len(chunk))
+            self.conn.execute('DELETE FROM fragments WHERE key IN (%s)' % marks, chunk)
+            self.conn.execute('DELETE FROM journal WHERE key IN (%s)' % marks, chunk)
+        self.conn.commit()
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib.chunker
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Split the content of a section into SSML fragments that Polly accepts.
+
+    Content is a list of ``[character count, join flag, SSML text]`` items.
+    Text items have the count of spoken characters, markup items have 0.
+
+    The chunker runs in one pass: it remembers the last boundary of each
+    quality (after a break, after a sentence, after a clause, between
+    words) and when the next item overflows the limit, it cuts at the best
+    one that keeps the fragment reasonably full.
+
+    With ``anchor``, breaks and sentence ends are also content-defined cut
+    points: the decision depends only on the hash of the sentence before
+    it, so inserting or removing text moves boundaries only around the
+    edit, and the other fragments keep their cache keys.
+
+    :class:`Chunker` takes items one by one and emits each fragment as soon
+    as it is cut, so only the items after the last cut are kept.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+from array import array
+import re
+import zlib
+from xml.sax.saxutils import escape, unescape
+
+# join flags
+REGULAR = 0
+JOIN_AFTER = 1
+JOIN_BEFORE = 2
+
+# Polly's limit of the whole request including SSML tags
+MAX_REQUEST_CHARACTERS = 6000
+
+# a fragment is cut at a worse boundary rather than at a better one
+# that makes it less than this ratio of the limit
+MIN_FILL = 0.5
+
+# content-defined boundaries are not made in the first quarter of the limit
+MIN_ANCHOR_FILL = 0.25
+
+# boundary quality
+BREAK = 4
+SENTENCE = 3
+CLAUSE = 2
+WORD = 1
+NONE = 0
+
+# the leading run without punctuation and newlines is matched greedily. it finds
+# the same pieces as the lazy match alone, without trying the ends at every character
+PIECE = re.compile(r'[^.!?,;:\n。！？、，]*.*?(?:[.!?]+["\')\]]*(?:\s+|$)|[,;:](?:\s+|$)|[。！？、，]+\s*|$)', re.S)
+SENTENCE_TAIL = re.compile(r'(?:[.!?]["\')\]]*\s+|[.!?]["\')\]]*$|[。！？]\s*)$')
+CLAUSE_TAIL = re.compile(r'(?:[,;:]\s+|[,;:]$|[、，]\s*)$')
+TAG = re.compile(r'<[^>]*>')
+
+
+def split_sentences(text):
+    """Split raw text into sentence and clause pieces. Whitespace stays with the former piece."""
+    return [piece for piece in PIECE.findall(text) if piece]
+
+
+def billed_characters(ssml):
+    """Characters that Polly bills for the SSML document: text without tags."""
+    return len(unescape(TAG.sub('', ssml)))
+
+
+def boundary_score(item):
+    """Quality of a cut just after ``item``."""
+    return _score(item[0], item[2])
+
+
+def _score(count, text):
+    if count == 0:
+        if text.endswith('/>'):
+            return BREAK
+        return SENTENCE if text.startswith('</') else NONE
+    if SENTENCE_TAIL.search(text):
+        return SENTENCE
+    if CLAUSE_TAIL.search(text):
+        return CLAUSE
+    if text[-1:].isspace():
+        return WORD
+    return NONE
+
+
+def is_anchor(text, count, gap):
+    """Whether a sentence is a content-defined boundary.
+
+    The probability is proportional to the length of the sentence, so
+    boundaries appear every ``gap`` characters on average.
+    """
+    threshold = min(1.0, count / gap) * 0xffffffff
+    return zlib.crc32(text.encode('utf-8')) < threshold
+
+
+def _split_long_items(contents, limit):
+    for item in contents:
+        if item[0] <= limit:
+            yield item
+            continue
+        # a sentence longer than the limit: split between words
+        raw = unescape(item[2])
+        piece = ''
+        for word in re.findall(r'\S*\s*', raw):
+            while len(word) > limit:
+                if piece:
+                    yield [len(piece), REGULAR, escape(piece)]
+                    piece = ''
+                yield [limit, REGULAR, escape(word[:limit])]
+                word = word[limit:]
+            if len(piece) + len(word) > limit:
+                yield [len(piece), REGULAR, escape(piece)]
+                piece = ''
+            piece += word
+        if piece:
+            yield [len(piece), item[1], escape(piece)]
+
+
+class Chunker:
+    """Streaming chunker. Items are given by :meth:`add`, and each fragment is
+    passed to ``emit(count, text, index, final)`` as soon as it is cut.
+
+    ``index`` counts the fragments from 1. ``final`` is true only for the
+    fragment emitted by :meth:`finish`, so a fragment that is not final
+    always has a successor. Pending items are kept in parallel arrays.
+    See :func:`chunk` for the other arguments.
+    """
+    def __init__(self, limit, emit, max_request=MAX_REQUEST_CHARACTERS, anchor=None):
+        self.limit = limit
+        self.emit = emit
+        self.max_request = max_request
+        self.anchor = anchor
+        self.counts = array('l')
+        self.flags = bytearray()
+        self.texts = []
+        # absolute indexes of the first pending item and of the next item
+        self.start = 0
+        self.next = 0
+        self.count = 0
+        self.size = 0
+        # score -> (index, count, size) of the latest boundary of the score
+        self.boundaries = {}
+        # the last spoken piece: (text, count)
+        self.last_text = None
+        # don't cut inside elements like <emphasis>
+        self.depth = 0
+        self.emitted = 0
+
+    def add(self, count, flag, text):
+        if count <= self.limit:
+            self._add(count, flag, text)
+            return
+        for item in _split_long_items([[count, flag, text]], self.limit):
+            self._add(*item)
+
+    def add_text(self, text):
+        """Add raw text as escaped sentence and clause pieces, like :meth:`add`
+        of each piece of :func:`split_sentences`.
+        """
+        quote = '&' in text or '<' in text or '>' in text
+        limit = self.limit
+        for piece in PIECE.findall(text):
+            if not piece:
+                continue
+            count = len(piece)
+            if quote:
+                piece = escape(piece)
+            if count <= limit:
+                self._add(count, REGULAR, piece)
+            else:
+                self.add(count, REGULAR, piece)
+
+    def _add(self, count, flag, text):
+        i = self.next
+        limit = self.limit
+        if i > self.start and self.depth == 0 and flag != JOIN_BEFORE and \
+                self.flags[-1] != JOIN_AFTER:
+            score = _score(self.counts[-1], self.texts[-1])
+            last_text = self.last_text
+            if (self.anchor and score >= SENTENCE and last_text is not None and
+                    self.count >= limit * MIN_ANCHOR_FILL and
+                    is_anchor(last_text[0], last_text[1], self.anchor)):
+                self._cut(i, self.count, self.size)
+            else:
+                self.boundaries[score] = (i, self.count, self.size)
+        if count == 0 and text.startswith('<') and not text.endswith('/>'):
+            self.depth += -1 if text.startswith('</') else 1
+        while i > self.start and (self.count + count > limit or
+                                  self.size + len(text) > self.max_request):
+            boundary = self._pick()
+            if boundary is None:
+                break
+            self._cut(*boundary)
+        self.counts.append(count)
+        self.flags.append(flag)
+        self.texts.append(text)
+        self.count += count
+        self.size += len(text)
+        if count:
+            self.last_text = (text, count)
+        self.next = i + 1
+
+    def _pick(self):
+        boundaries = self.boundaries
+        for score in (BREAK, SENTENCE, CLAUSE, WORD, NONE):
+            boundary = boundaries.get(score)
+            if boundary and boundary[1] >= self.limit * MIN_FILL:
+                return boundary
+        if boundaries:
+            return max(boundaries.values())
+        return None
+
+    def _cut(self, cut, cut_count, cut_size):
+        n = cut - self.start
+        text = ''.join(self.texts[:n])
+        del self.counts[:n]
+        del self.flags[:n]
+        del self.texts[:n]
+        self.start = cut
+        self.count -= cut_count
+        self.size -= cut_size
+        self.boundaries = {score: (index, c - cut_count, s - cut_size)
+                           for score, (index, c, s) in self.boundaries.items() if index > cut}
+        self.emitted += 1
+        self.emit(cut_count, text, self.emitted, False)
+
+    def finish(self):
+        """Emit the pending items as the final fragment and start over."""
+        if self.texts:
+            count, text, index = self.count, ''.join(self.texts), self.emitted + 1
+            self.__init__(self.limit, self.emit, self.max_request, self.anchor)
+            self.emit(count, text, index, True)
+        else:
+            self.__init__(self.limit, self.emit, self.max_request, self.anchor)
+
+
+def chunk(contents, limit, max_request=MAX_REQUEST_CHARACTERS, anchor=None):
+    """Split ``contents`` into ``(character count, SSML text)`` fragments.
+
+    Each fragment has at most ``limit`` spoken characters and
+    ``max_request`` characters including markup, unless no boundary exists.
+    ``anchor`` is the average characters between content-defined boundaries.
+    ``None`` makes fragments as large as possible.
+    """
+    outputs = []
+    chunker = Chunker(limit, lambda count, text, index, final: outputs.append((count, text)),
+                      max_request, anchor)
+    for item in contents:
+        chunker.add(*item)
+    chunker.finish()
+    return outputs
+
+
+SSML_WRAPPER = re.compile(r'^(<speak[^>]*>(?:<prosody[^>]*>)?)(.*?)((?:</prosody>)?</speak>)$', re.S)
+TOKEN = re.compile(r'<[^>]+>|[^<]+')
+
+
+def split_ssml(ssml):
+    """Split a complete SSML document into pieces of about half size.
+
+    It is used when Polly rejects a fragment as too long.
+    Returns a list of SSML documents (only one if it can't be split).
+    """
+    match = SSML_WRAPPER.match(ssml)
+    if not match:
+        return [ssml]
+    head, body, tail = match.groups()
+    items = []
+    for token in TOKEN.findall(body):
+        if token.startswith('<'):
+            items.append([0, REGULAR, token])
+        else:
+            for piece in split_sentences(unescape(token)):
+                items.append([len(piece), REGULAR, escape(piece)])
+    total = sum(item[0] for item in items)
+    if total < 2:
+        return [ssml]
+    fragments = chunk(items, max(1, (total + 1) // 2))
+    if len(fragments) < 2:
+        return [ssml]
+    return [head + text + tail for count, text in fragments]
+
+
+def join_ssml(documents, mark='<mark name="%d"/>'):
+    """Join complete SSML documents of the same settings into one.
+
+    ``mark % index`` is inserted before the content of each document.
+    """
+    head = tail = None
+    bodies = []
+    for i, document in enumerate(documents):
+        match = SSML_WRAPPER.match(document)
+        if not match or (head is not None and (match.group(1), match.group(3)) != (head, tail)):
+            raise ValueError('SSML documents of different settings can not be joined')
+        head, body, tail = match.groups()
+        bodies.append(mark % i + body)
+    return head + ''.join(bodies) + tail
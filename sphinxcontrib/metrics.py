@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib.metrics
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Build instrumentation: phase timers, counters and latency samples.
+
+    :class:`Metrics` is shared by the builder, the translator and the
+    synthesis thread. Parallel write workers record into their own
+    instance and send its :meth:`~Metrics.state` back to be merged.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import contextlib
+import math
+import threading
+import time
+
+try:
+    from sphinx.util import logging
+except ImportError:
+    # Sphinx < 1.6
+    import logging
+
+
+def get_logger(name):
+    return logging.getLogger(name)
+
+
+def percentile(values, ratio):
+    """Nearest-rank percentile of sorted ``values``."""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(ratio * len(values)) - 1)]
+
+
+class Metrics:
+    """Thread-safe timers (total seconds), counters and latency samples."""
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds, sample=False):
+        """Add ``seconds`` to the timer ``name``. ``sample`` keeps it for percentiles."""
+        with self._lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+            if sample:
+                self.samples.setdefault(name, []).append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, sample=False):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, sample)
+
+    def state(self):
+        """Picklable raw values for :meth:`merge`."""
+        with self._lock:
+            return {"timers": dict(self.timers), "counters": dict(self.counters),
+                    "samples": {name: list(values) for name, values in self.samples.items()}}
+
+    def merge(self, state):
+        with self._lock:
+            for name, seconds in state["timers"].items():
+                self.timers[name] = self.timers.get(name, 0.0) + seconds
+            for name, value in state["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, values in state["samples"].items():
+                self.samples.setdefault(name, []).extend(values)
+
+    def report(self):
+        """JSON-serializable summary with count, mean and percentiles of the samples."""
+        with self._lock:
+            latencies = {}
+            for name, values in self.samples.items():
+                values = sorted(values)
+                latencies[name] = {"count": len(values),
+                                   "mean": sum(values) / len(values) if values else 0.0,
+                                   "p50": percentile(values, 0.5),
+                                   "p90": percentile(values, 0.9),
+                                   "p99": percentile(values, 0.99),
+                                   "max": values[-1] if values else 0.0}
+            counters = dict(self.counters)
+            lookups = counters.get("cache_hits", 0) + counters.get("cache_misses", 0)
+            return {"timers": dict(sorted(self.timers.items())),
+                    "counters": dict(sorted(counters.items())),
+                    "latency": latencies,
+                    "cache_hit_ratio": counters.get("cache_hits", 0) / lookups if lookups else None}
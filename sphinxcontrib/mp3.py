@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib.mp3
+    ~~~~~~~~~~~~~~~~~
+
+    Minimal MPEG audio frame parser and concatenator.
+
+    :func:`concatenate` joins MP3 fragments without ffmpeg. Per-fragment
+    ID3 tags and Xing/Info/VBRI header frames are dropped, and the audio
+    frames of each fragment are copied back to back in the kernel
+    (``os.copy_file_range``/``os.sendfile``). A new ID3v2.3 tag and Xing
+    header are written in front of them.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import array
+import os
+import struct
+
+MPEG1 = 3
+MPEG2 = 2
+MPEG25 = 0
+
+BITRATES = {
+    (MPEG1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (MPEG1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (MPEG1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (MPEG2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (MPEG2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (MPEG2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+SAMPLE_RATES = {
+    MPEG1: [44100, 48000, 32000],
+    MPEG2: [22050, 24000, 16000],
+    MPEG25: [11025, 12000, 8000],
+}
+
+
+class FrameHeader:
+    """Decoded 4 byte MPEG audio frame header."""
+    __slots__ = ('version', 'layer', 'bitrate', 'sample_rate', 'padding',
+                 'channel_mode', 'length', 'samples')
+
+    def __init__(self, version, layer, bitrate, sample_rate, padding, channel_mode):
+        self.version = version
+        self.layer = layer
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.channel_mode = channel_mode
+        if layer == 1:
+            self.samples = 384
+            self.length = (12 * bitrate * 1000 // sample_rate + padding) * 4
+        else:
+            self.samples = 1152 if (layer == 2 or version == MPEG1) else 576
+            self.length = self.samples // 8 * bitrate * 1000 // sample_rate + padding
+
+
+def parse_header(data):
+    """Return :class:`FrameHeader` for 4 bytes, or ``None`` if it is not a frame header."""
+    if len(data) < 4 or data[0] != 0xff or (data[1] & 0xe0) != 0xe0:
+        return None
+    version = (data[1] >> 3) & 0x03
+    layer = 4 - ((data[1] >> 1) & 0x03)
+    bitrate_index = data[2] >> 4
+    sample_rate_index = (data[2] >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = BITRATES[(MPEG1 if version == MPEG1 else MPEG2, layer)][bitrate_index]
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    padding = (data[2] >> 1) & 0x01
+    channel_mode = data[3] >> 6
+    return FrameHeader(version, layer, bitrate, sample_rate, padding, channel_mode)
+
+
+def side_info_size(header):
+    if header.version == MPEG1:
+        return 17 if header.channel_mode == 3 else 32
+    return 9 if header.channel_mode == 3 else 17
+
+
+def is_info_frame(data, header):
+    """Whether the frame ``data`` is a Xing/Info/VBRI header frame (not audio)."""
+    offset = 4 + side_info_size(header)
+    if data[1] & 0x01 == 0:
+        # protected by CRC
+        offset += 2
+    return data[offset:offset + 4] in (b'Xing', b'Info') or data[36:40] == b'VBRI'
+
+
+def id3v2_size(data):
+    """Return total size of ID3v2 tag at the beginning of ``data`` (10 bytes at least)."""
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def iter_frames(f):
+    """Yield ``(offset, header)`` for each audio frame in the binary file object."""
+    head = f.read(10)
+    offset = id3v2_size(head)
+    f.seek(offset)
+    while True:
+        data = f.read(4)
+        header = parse_header(data)
+        if header is None or header.length < 4:
+            return
+        yield offset, header
+        offset += header.length
+        f.seek(offset)
+
+
+class AudioRange:
+    """Byte range ``[start, end)`` of the audio frames in a file.
+
+    ``sizes`` is an array of the frame lengths and ``header`` is the first
+    frame header.
+    """
+    __slots__ = ('start', 'end', 'header', 'sizes', 'bitrates')
+
+    def __init__(self):
+        self.start = None
+        self.end = None
+        self.header = None
+        self.sizes = array.array('H')
+        self.bitrates = set()
+
+    @property
+    def duration(self):
+        if self.header is None:
+            return 0.0
+        return len(self.sizes) * self.header.samples / self.header.sample_rate
+
+
+def scan(f):
+    """Return :class:`AudioRange` of the binary file object ``f``."""
+    result = AudioRange()
+    for offset, header in iter_frames(f):
+        if result.start is None:
+            f.seek(offset)
+            if is_info_frame(f.read(header.length), header):
+                continue
+            result.start = offset
+            result.header = header
+        result.sizes.append(header.length)
+        result.bitrates.add(header.bitrate)
+        result.end = offset + header.length
+    if result.start is None:
+        result.start = result.end = 0
+    return result
+
+
+def duration(filepath):
+    """Play time (seconds) of the MP3 file."""
+    with open(filepath, 'rb') as f:
+        return scan(f).duration
+
+
+def split_ranges(audio, times):
+    """Byte ranges of :class:`AudioRange` ``audio`` cut at the frames nearest to ``times``.
+
+    ``times`` are the start times (seconds) of the pieces in ascending order.
+    The first piece always starts at the first frame and the last one ends
+    at the last frame.
+    """
+    offsets = [audio.start]
+    for size in audio.sizes:
+        offsets.append(offsets[-1] + size)
+    count = len(audio.sizes)
+    if audio.header is None or not times:
+        return [(audio.start, audio.start)] * len(times)
+    frame_seconds = audio.header.samples / audio.header.sample_rate
+    indexes = [0]
+    for t in times[1:]:
+        indexes.append(min(count, max(indexes[-1], int(round(t / frame_seconds)))))
+    indexes.append(count)
+    return [(offsets[a], offsets[b]) for a, b in zip(indexes, indexes[1:])]
+
+
+ID3_FRAMES = [
+    ('album', 'TALB'),
+    ('author', 'TPE1'),
+    ('title', 'TIT2'),
+    ('track', 'TRCK'),
+    ('genre', 'TCON'),
+    ('year', 'TYER'),
+]
+
+
+def _syncsafe(value):
+    return bytes([(value >> 21) & 0x7f, (value >> 14) & 0x7f, (value >> 7) & 0x7f, value & 0x7f])
+
+
+def id3v2_tag(metadata):
+    """Build ID3v2.3 tag from ``metadata`` keys of :data:`ID3_FRAMES`."""
+    frames = []
+    for key, frame_id in ID3_FRAMES:
+        value = metadata.get(key)
+        if value is None or value == '':
+            continue
+        # encoding 1: UTF-16 with BOM
+        data = b'\x01' + str(value).encode('utf-16')
+        frames.append(frame_id.encode('ascii') + struct.pack('>IH', len(data), 0) + data)
+    body = b''.join(frames)
+    return b'ID3\x03\x00\x00' + _syncsafe(len(body)) + body
+
+
+def xing_frame(header, sizes, vbr):
+    """Build Xing (``vbr``) or Info header frame for the frames of ``sizes``."""
+    # the smallest bitrate that can hold the header, 4 fields and TOC
+    needed = 4 + side_info_size(header) + 4 + 4 + 4 + 4 + 100
+    table = BITRATES[(MPEG1 if header.version == MPEG1 else MPEG2, header.layer)]
+    for index, bitrate in enumerate(table):
+        if bitrate == 0:
+            continue
+        frame = FrameHeader(header.version, header.layer, bitrate, header.sample_rate, 0,
+                            header.channel_mode)
+        if frame.length >= needed:
+            break
+    sample_rate_index = SAMPLE_RATES[header.version].index(header.sample_rate)
+    head = bytes([0xff,
+                  0xe0 | (header.version << 3) | ((4 - header.layer) << 1) | 0x01,
+                  (index << 4) | (sample_rate_index << 2),
+                  header.channel_mode << 6])
+
+    total = frame.length + sum(sizes)
+    toc = bytearray(100)
+    if sizes:
+        offset = frame.length
+        position = 0
+        for i in range(100):
+            target = i * len(sizes) // 100
+            while position < target:
+                offset += sizes[position]
+                position += 1
+            toc[i] = min(255, offset * 256 // total)
+
+    data = bytearray(frame.length)
+    data[0:4] = head
+    offset = 4 + side_info_size(header)
+    data[offset:offset + 4] = b'Xing' if vbr else b'Info'
+    # frames, bytes and TOC fields are present
+    data[offset + 4:offset + 16] = struct.pack('>III', 0x07, len(sizes), total)
+    data[offset + 16:offset + 116] = toc
+    return bytes(data)
+
+
+def silence(seconds, sample_rate=22050, bitrate=48):
+    """MP3 data of ``seconds`` of silence (mono, layer III).
+
+    All side information is zero, so every frame decodes to silence.
+    """
+    for version, rates in SAMPLE_RATES.items():
+        if sample_rate in rates:
+            break
+    else:
+        raise ValueError('unsupported sample rate: %s' % sample_rate)
+    table = BITRATES[(MPEG1 if version == MPEG1 else MPEG2, 3)]
+    head = bytes([0xff,
+                  0xe0 | (version << 3) | (1 << 1) | 0x01,
+                  (table.index(bitrate) << 4) | (rates.index(sample_rate) << 2),
+                  3 << 6])
+    header = parse_header(head)
+    frames = max(1, int(round(seconds * sample_rate / header.samples)))
+    return (head + bytes(header.length - 4)) * frames
+
+
+def _copy_range(src, dst, start, count):
+    offset = start
+    end = start + count
+    try:
+        if hasattr(os, 'copy_file_range'):
+            while offset < end:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), end - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        elif hasattr(os, 'sendfile'):
+            while offset < end:
+                copied = os.sendfile(dst.fileno(), src.fileno(), offset, end - offset)
+                if copied == 0:
+                    break
+                offset += copied
+    except OSError:
+        # e.g. file systems that don't support it
+        pass
+    if offset < end:
+        src.seek(offset)
+        dst.seek(0, os.SEEK_END)
+        remaining = end - offset
+        while remaining:
+            chunk = src.read(min(remaining, 64 * 1024))
+            if not chunk:
+                raise IOError('unexpected end of file: %s' % src.name)
+            dst.write(chunk)
+            remaining -= len(chunk)
+
+
+def concatenate(sources, dest, metadata=None):
+    """Join MP3 files of ``sources`` into ``dest`` with ID3v2 tag of ``metadata``.
+
+    It writes into a temporary file and renames it at last.
+    Returns the play time in seconds.
+    """
+    ranges = []
+    header = None
+    sizes = array.array('H')
+    bitrates = set()
+    for source in sources:
+        with open(source, 'rb') as f:
+            audio = scan(f)
+        if audio.header is None:
+            continue
+        if header is None:
+            header = audio.header
+        elif (audio.header.version, audio.header.layer, audio.header.sample_rate) != \
+                (header.version, header.layer, header.sample_rate):
+            raise ValueError('%s has different sampling format' % source)
+        ranges.append((source, audio.start, audio.end - audio.start))
+        sizes.extend(audio.sizes)
+        bitrates.update(audio.bitrates)
+
+    tmppath = '%s.%d.part' % (dest, os.getpid())
+    try:
+        with open(tmppath, 'wb') as out:
+            out.write(id3v2_tag(metadata or {}))
+            if header is not None:
+                out.write(xing_frame(header, sizes, len(bitrates) > 1))
+            out.flush()
+            for source, start, count in ranges:
+                with open(source, 'rb') as src:
+                    out.seek(0, os.SEEK_END)
+                    _copy_range(src, out, start, count)
+        os.replace(tmppath, dest)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+    if header is None:
+        return 0.0
+    return len(sizes) * header.samples / header.sample_rate
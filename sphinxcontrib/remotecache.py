@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib.remotecache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Remote fragment cache tier behind the local cache.
+
+    Fragments are stored as ``<key[:2]>/<key>.mp3`` by their synthesis key
+    (:func:`~sphinxcontrib.cache.synthesis_key`), so any build that needs the
+    same audio finds it, whichever node synthesized it.
+
+    * :class:`FileSystemCache`: a shared directory (NFS, SMB and so on).
+    * :class:`S3Cache`: an S3 compatible bucket, ``s3://bucket/prefix``.
+
+    Before synthesis, the builder asks the remote cache which of the
+    fragments to synthesize it has, downloads them in parallel, and
+    uploads the fragments synthesized by the build afterwards.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import os
+from os import path
+import shutil
+from urllib.parse import urlparse
+
+from sphinx.errors import ConfigError
+
+from .synthesis import CHUNK_SIZE, FragmentOutput, create_s3_client
+from .throttling import exectasks
+
+# groups of keys up to this size are checked one by one instead of listing
+HEAD_LIMIT = 2
+
+
+class RemoteCache:
+    """Base class of the remote cache tiers. Subclasses implement
+    :meth:`contains`, :meth:`fetch` and :meth:`store`.
+    """
+    max_retries = 2
+
+    def __init__(self, workers=8):
+        self.workers = workers
+
+    def object_name(self, key):
+        return '%s/%s.mp3' % (key[:2], key)
+
+    def _run(self, tasks, consumer):
+        return exectasks(0, tasks, consumer, concurrency=self.workers,
+                         max_concurrency=self.workers, max_retries=self.max_retries,
+                         is_retryable=self.is_retryable)
+
+    def is_retryable(self, err):
+        return False
+
+    def contains(self, key):
+        raise NotImplementedError
+
+    def exists(self, keys):
+        """Return the subset of ``keys`` that the remote cache has."""
+        results, failures = self._run(list(keys), self.contains)
+        if failures:
+            raise next(iter(failures.values()))
+        return {key for key, found in results.items() if found}
+
+    def fetch(self, key, output):
+        """Write the fragment of ``key`` to ``output`` (:class:`~sphinxcontrib.synthesis.FragmentOutput`)."""
+        raise NotImplementedError
+
+    def store(self, key, filepath):
+        raise NotImplementedError
+
+    def prefetch(self, index, keys):
+        """Download ``keys`` into the cache of ``index``.
+
+        Returns ``(fetched, failures)``: the fetched keys and ``{key: error}``.
+        """
+        def download(key):
+            output = FragmentOutput(index.filepath(key))
+            try:
+                self.fetch(key, output)
+                output.commit()
+            except Exception:
+                output.discard()
+                raise
+            index.complete(key, output.size, output.checksum)
+        results, failures = self._run(list(keys), download)
+        return set(results), failures
+
+    def upload(self, index, keys):
+        """Upload the fragments of ``keys`` from the cache of ``index``.
+
+        Returns ``(uploaded, failures)`` like :meth:`prefetch`.
+        """
+        results, failures = self._run(list(keys),
+                                      lambda key: self.store(key, index.filepath(key)))
+        return set(results), failures
+
+
+class FileSystemCache(RemoteCache):
+    """Remote cache in a shared directory."""
+    def __init__(self, root, workers=8):
+        super().__init__(workers)
+        self.root = root
+
+    def is_retryable(self, err):
+        # network file systems have transient errors
+        return isinstance(err, OSError) and not isinstance(err, FileNotFoundError)
+
+    def filepath(self, key):
+        return path.join(self.root, *self.object_name(key).split('/'))
+
+    def contains(self, key):
+        return path.exists(self.filepath(key))
+
+    def fetch(self, key, output):
+        with open(self.filepath(key), 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                output.write(chunk)
+
+    def store(self, key, filepath):
+        dest = self.filepath(key)
+        os.makedirs(path.dirname(dest), exist_ok=True)
+        # other nodes never see a partial file
+        tmppath = '%s.%d.part' % (dest, os.getpid())
+        shutil.copyfile(filepath, tmppath)
+        os.replace(tmppath, dest)
+
+
+class S3Cache(RemoteCache):
+    """Remote cache in an S3 compatible bucket.
+
+    Keys are checked by listing their ``<key[:2]>/`` prefix, so one request
+    answers for many keys.
+    """
+    def __init__(self, bucket, prefix='', endpoint_url=None, profile=None, workers=8):
+        from boto3 import Session
+        super().__init__(workers)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = create_s3_client(Session(profile_name=profile or None), endpoint_url, workers)
+
+    def is_retryable(self, err):
+        from botocore.exceptions import BotoCoreError, ClientError
+        if isinstance(err, ClientError):
+            status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            return status >= 500 or status == 429
+        return isinstance(err, BotoCoreError)
+
+    def object_key(self, key):
+        return self.prefix + self.object_name(key)
+
+    def contains(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+            return True
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def _listing(self, group):
+        found = set()
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + group + '/'):
+            for item in page.get('Contents', ()):
+                name = item['Key'].rsplit('/', 1)[-1]
+                if name.endswith('.mp3'):
+                    found.add(name[:-4])
+        return found
+
+    def exists(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(key[:2], set()).add(key)
+        small = [key for group in groups.values() if len(group) <= HEAD_LIMIT for key in group]
+        result = super().exists(small)
+        large = [name for name, group in groups.items() if len(group) > HEAD_LIMIT]
+        results, failures = self._run(large, self._listing)
+        if failures:
+            raise next(iter(failures.values()))
+        for name, found in results.items():
+            result.update(found & groups[name])
+        return result
+
+    def fetch(self, key, output):
+        body = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))["Body"]
+        try:
+            for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+                output.write(chunk)
+        finally:
+            body.close()
+
+    def store(self, key, filepath):
+        with open(filepath, 'rb') as f:
+            self.client.put_object(Bucket=self.bucket, Key=self.object_key(key), Body=f,
+                                   ContentType='audio/mpeg')
+
+
+def create_remote_cache(builder):
+    """Remote cache of ``ssml_remote_cache``: a directory or ``s3://bucket/prefix``."""
+    location = builder.ssml_remote_cache
+    if not location:
+        return None
+    workers = builder.ssml_remote_cache_workers
+    if '://' not in location:
+        return FileSystemCache(path.abspath(path.expanduser(location)), workers)
+    url = urlparse(location)
+    if url.scheme != 's3' or not url.netloc:
+        raise ConfigError('unsupported ssml_remote_cache: %r (directory or s3://bucket/prefix)'
+                          % location)
+    prefix = url.path.lstrip('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return S3Cache(url.netloc, prefix, builder.ssml_remote_cache_endpoint_url,
+                   builder.ssml_polly_aws_profile, workers)
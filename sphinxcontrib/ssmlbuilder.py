@@ -18,6 +18,8 @@ from .builder import SSMLBuilder
 def setup(app):
     app.require_sphinx('1.5')
     app.add_builder(SSMLBuilder)
+    # called with the build report dict after MP3 files are made
+    app.add_event('ssml-build-report')
     app.add_config_value('ssml_language', "en-US", True)
     app.add_config_value('ssml_break_around_section_title', [2000, 1600, 1000, 1000, 1000, 1000], True)
     app.add_config_value('ssml_emphasis_section_title', ['none', 'none', 'none', 'none', 'none', 'none'], True)
@@ -28,3 +30,34 @@ def setup(app):
     app.add_config_value('ssml_polly_aws_profile', "", False)
     app.add_config_value('ssml_polly_aws_voiceid', "Joanna", True)
     app.add_config_value('ssml_polly_apply_docnames', "", False)
+    app.add_config_value('ssml_polly_rate_limit', 8, False)
+    app.add_config_value('ssml_polly_rate_burst', 10, False, (int, float, type(None)))
+    app.add_config_value('ssml_polly_concurrency', 4, False)
+    app.add_config_value('ssml_polly_max_concurrency', 16, False)
+    app.add_config_value('ssml_polly_max_retries', 8, False)
+    app.add_config_value('ssml_polly_backoff_base', 0.5, False)
+    app.add_config_value('ssml_polly_backoff_max', 20.0, False)
+    app.add_config_value('ssml_polly_endpoint_url', None, False)
+    app.add_config_value('ssml_polly_engine', 'standard', True)
+    app.add_config_value('ssml_polly_sample_rate', None, True)
+    app.add_config_value('ssml_polly_synthesize_while_writing', True, False)
+    app.add_config_value('ssml_assembly_workers', None, False)
+    app.add_config_value('ssml_assembler', 'builtin', False)
+    app.add_config_value('ssml_polly_text_limits', {'standard': 3000, 'neural': 3000}, True)
+    app.add_config_value('ssml_fragment_boundaries', 'content', True)
+    app.add_config_value('ssml_polly_plan_only', False, False)
+    app.add_config_value('ssml_polly_character_budget', None, False)
+    app.add_config_value('ssml_tts_backend', 'polly', True)
+    app.add_config_value('ssml_tts_workers', None, False)
+    app.add_config_value('ssml_polly_task_bucket', None, False)
+    app.add_config_value('ssml_polly_task_prefix', 'ssmlbuilder/', False)
+    app.add_config_value('ssml_polly_s3_endpoint_url', None, False)
+    app.add_config_value('ssml_polly_task_characters', 100000, False)
+    app.add_config_value('ssml_polly_shards', None, False)
+    app.add_config_value('ssml_cache_dir', None, False)
+    app.add_config_value('ssml_cache_max_size', None, False)
+    app.add_config_value('ssml_cache_max_age', 30, False, (int, float, type(None)))
+    app.add_config_value('ssml_remote_cache', None, False)
+    app.add_config_value('ssml_remote_cache_endpoint_url', None, False)
+    app.add_config_value('ssml_remote_cache_workers', 8, False)
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
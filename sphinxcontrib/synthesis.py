@@ -0,0 +1,703 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib.synthesis
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    asyncio based speech synthesis pipeline.
+
+    The number of in-flight requests is bounded by the AIMD controller of
+    :mod:`sphinxcontrib.throttling`, and every audio body is streamed to
+    disk in :data:`CHUNK_SIZE` pieces, so memory use does not depend on
+    the fragment size. Requests are spread over one or more :class:`Shard`
+    (for example Polly clients of different profiles and regions), each
+    with its own rate limit, concurrency and health.
+
+    If ``aiobotocore`` is installed, Polly requests are sent by a native
+    asyncio client. Otherwise boto3 calls run in a thread pool sized to the
+    maximum concurrency. Offline backends (:mod:`sphinxcontrib.backends`)
+    render fragments in a process pool. :class:`BatchSynthesisEngine` with
+    :class:`PollyTaskClient` sends batches of fragments as long-form Polly
+    tasks.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+from . import mp3
+from .cache import file_checksum
+from .chunker import billed_characters, join_ssml
+from .metrics import Metrics
+
+try:
+    from aiobotocore.session import AioSession
+    from aiobotocore.config import AioConfig
+except ImportError:
+    AioSession = None
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class SynthesisJob:
+    """One fragment to synthesize: cache ``key``, SSML ``text`` and output ``dest``.
+
+    ``name`` is the SSML file name for messages.
+    """
+    __slots__ = ('key', 'text', 'dest', 'name')
+
+    def __init__(self, key, text, dest, name=None):
+        self.key = key
+        self.text = text
+        self.dest = dest
+        self.name = name or key
+
+
+def part_path(dest):
+    return '%s.%d.part' % (dest, os.getpid())
+
+
+class FragmentOutput:
+    """Write a fragment to a temporary file, and rename it to ``dest`` on success.
+
+    The size and SHA-256 checksum are computed while writing.
+    A killed build leaves only the ``.part`` file, never a truncated fragment.
+    """
+    def __init__(self, dest):
+        self.dest = dest
+        self.tmppath = part_path(dest)
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = open(self.tmppath, 'wb')
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def checksum(self):
+        return self._hash.hexdigest()
+
+    def commit(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.tmppath, self.dest)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.tmppath)
+        except FileNotFoundError:
+            pass
+
+
+class BotoPollyClient:
+    """boto3 client. Blocking calls run in a thread pool."""
+    def __init__(self, profile, request, endpoint_url=None, max_pool=10, region=None):
+        self.profile = profile
+        self.request = request
+        self.endpoint_url = endpoint_url
+        self.max_pool = max_pool
+        self.region = region
+        self._executor = None
+        self._client = None
+
+    async def __aenter__(self):
+        from boto3 import Session
+        from botocore.config import Config
+        session = Session(profile_name=self.profile or None, region_name=self.region or None)
+        # retries are handled by the engine to adapt request rate
+        self._client = session.client("polly", endpoint_url=self.endpoint_url or None,
+                                      config=Config(retries={'max_attempts': 0},
+                                                    max_pool_connections=self.max_pool))
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.max_pool)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._executor.shutdown()
+
+    def _synthesize(self, text, output):
+        response = self._client.synthesize_speech(Text=text, **self.request)
+        stream = response["AudioStream"]
+        try:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+        finally:
+            stream.close()
+
+    async def synthesize(self, text, output):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self._executor, self._synthesize, text, output)
+
+
+class AioPollyClient:
+    """Native asyncio client by aiobotocore."""
+    def __init__(self, profile, request, endpoint_url=None, max_pool=10, region=None):
+        self.profile = profile
+        self.request = request
+        self.endpoint_url = endpoint_url
+        self.max_pool = max_pool
+        self.region = region
+        self._context = None
+        self._client = None
+
+    async def __aenter__(self):
+        session = AioSession(profile=self.profile or None)
+        self._context = session.create_client(
+            "polly", region_name=self.region or None, endpoint_url=self.endpoint_url or None,
+            config=AioConfig(retries={'max_attempts': 0}, max_pool_connections=self.max_pool))
+        self._client = await self._context.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._context.__aexit__(*exc)
+
+    async def synthesize(self, text, output):
+        response = await self._client.synthesize_speech(Text=text, **self.request)
+        stream = response["AudioStream"]
+        try:
+            while True:
+                chunk = await stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+        finally:
+            stream.close()
+
+
+class ProcessPoolClient:
+    """Client of the offline backends: ``render(text)`` returns MP3 data in a process pool."""
+    def __init__(self, render, workers):
+        self.render = render
+        self.workers = workers
+        self._executor = None
+
+    async def __aenter__(self):
+        self._executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._executor.shutdown()
+
+    async def synthesize(self, text, output):
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(self._executor, self.render, text)
+        for i in range(0, len(data), CHUNK_SIZE):
+            output.write(data[i:i + CHUNK_SIZE])
+
+
+def create_s3_client(session, endpoint_url=None, max_pool=10):
+    """S3 client of the boto3 ``session``. ``endpoint_url`` points to an S3 compatible server."""
+    from botocore.config import Config
+    # a local S3 stand-in doesn't resolve virtual host style bucket names
+    s3_config = {'addressing_style': 'path'} if endpoint_url else None
+    return session.client("s3", endpoint_url=endpoint_url or None,
+                          config=Config(max_pool_connections=max_pool, s3=s3_config))
+
+
+class PollyTaskClient:
+    """Long-form client by Polly's asynchronous task API.
+
+    A batch of fragments is joined into one SSML document with a ``<mark>``
+    before each fragment. Two tasks write the audio and the SSML speech
+    marks to the S3 ``bucket``, and the audio is cut at the mark times
+    into the fragments. boto3 calls run in a thread pool.
+    """
+    # both tasks are billed for the text
+    billed_passes = 2
+
+    def __init__(self, profile, request, bucket, prefix='', endpoint_url=None,
+                 s3_endpoint_url=None, max_pool=10, poll_interval=1.0, poll_max=15.0,
+                 timeout=3600.0, region=None):
+        self.profile = profile
+        self.region = region
+        # OutputFormat differs between the audio and speech marks tasks
+        self.request = {key: value for key, value in request.items() if key != "OutputFormat"}
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.s3_endpoint_url = s3_endpoint_url
+        self.max_pool = max_pool
+        self.poll_interval = poll_interval
+        self.poll_max = poll_max
+        self.timeout = timeout
+        self._executor = None
+        self._polly = None
+        self._s3 = None
+
+    async def __aenter__(self):
+        from boto3 import Session
+        from botocore.config import Config
+        session = Session(profile_name=self.profile or None, region_name=self.region or None)
+        self._polly = session.client("polly", endpoint_url=self.endpoint_url or None,
+                                     config=Config(retries={'max_attempts': 0},
+                                                   max_pool_connections=self.max_pool))
+        self._s3 = create_s3_client(session, self.s3_endpoint_url, self.max_pool)
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.max_pool)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._executor.shutdown()
+
+    def _start(self, text, request):
+        response = self._polly.start_speech_synthesis_task(
+            Text=text, OutputS3BucketName=self.bucket, OutputS3KeyPrefix=self.prefix, **request)
+        return response["SynthesisTask"]["TaskId"]
+
+    def _wait(self, task_id):
+        """Poll the task with growing interval. Returns the output URI."""
+        deadline = time.monotonic() + self.timeout
+        interval = self.poll_interval
+        while True:
+            task = self._polly.get_speech_synthesis_task(TaskId=task_id)["SynthesisTask"]
+            if task["TaskStatus"] == "completed":
+                return task["OutputUri"]
+            if task["TaskStatus"] == "failed":
+                raise RuntimeError("synthesis task %s failed: %s" % (
+                    task_id, task.get("TaskStatusReason", "")))
+            if time.monotonic() + interval > deadline:
+                raise TimeoutError("synthesis task %s is not completed" % task_id)
+            time.sleep(interval)
+            interval = min(self.poll_max, interval * 1.5)
+
+    def _object_key(self, uri):
+        key = urlparse(uri).path.lstrip('/')
+        # path style URI includes the bucket name
+        if key.startswith(self.bucket + '/'):
+            key = key[len(self.bucket) + 1:]
+        return key
+
+    def _download(self, key, f):
+        body = self._s3.get_object(Bucket=self.bucket, Key=key)["Body"]
+        try:
+            for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+                f.write(chunk)
+        finally:
+            body.close()
+
+    def _synthesize_batch(self, texts, outputs):
+        ssml = join_ssml(texts)
+        audio_task = self._start(ssml, dict(self.request, OutputFormat="mp3"))
+        # sample rate is only for audio
+        marks_request = {key: value for key, value in self.request.items() if key != "SampleRate"}
+        marks_task = self._start(ssml, dict(marks_request, OutputFormat="json",
+                                            SpeechMarkTypes=["ssml"]))
+        keys = [self._object_key(self._wait(audio_task)), self._object_key(self._wait(marks_task))]
+        tmppath = outputs[0].tmppath + '.task'
+        try:
+            marks = {}
+            with open(tmppath, 'w+b') as f:
+                self._download(keys[1], f)
+                f.seek(0)
+                for line in f:
+                    if line.strip():
+                        mark = json.loads(line.decode('utf-8'))
+                        marks[mark["value"]] = mark["time"] / 1000.0
+            with open(tmppath, 'w+b') as f:
+                self._download(keys[0], f)
+                f.seek(0)
+                ranges = mp3.split_ranges(mp3.scan(f), [marks[str(i)] for i in range(len(texts))])
+                for (start, end), output in zip(ranges, outputs):
+                    f.seek(start)
+                    remaining = end - start
+                    while remaining:
+                        chunk = f.read(min(remaining, CHUNK_SIZE))
+                        if not chunk:
+                            raise IOError('unexpected end of synthesis task output')
+                        output.write(chunk)
+                        remaining -= len(chunk)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            for key in keys:
+                try:
+                    self._s3.delete_object(Bucket=self.bucket, Key=key)
+                except Exception:
+                    pass
+
+    async def synthesize_batch(self, texts, outputs):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self._executor, self._synthesize_batch, texts, outputs)
+
+
+def create_polly_client(profile, request, endpoint_url=None, max_pool=10, region=None):
+    if AioSession is not None:
+        return AioPollyClient(profile, request, endpoint_url, max_pool, region)
+    return BotoPollyClient(profile, request, endpoint_url, max_pool, region)
+
+
+class Shard:
+    """A client with its own :class:`~sphinxcontrib.throttling.Throttle` and health.
+
+    After a throttling or retryable error the shard rests for the backoff
+    delay, and the engine sends work to the other shards in the meantime.
+    The delay grows with the failures in a row, counted once per rest, so
+    a failing shard is tried less and less often.
+    """
+    def __init__(self, name, client, throttle):
+        self.name = name
+        self.client = client
+        self.throttle = throttle
+        self.inflight = 0
+        self.resting_until = 0.0
+        self.consecutive_failures = 0
+        self.stats = {"calls": 0, "succeeded": 0, "throttles": 0, "failures": 0}
+
+    def failed(self):
+        """Record a throttling or retryable error. Returns seconds to rest."""
+        self.stats["failures"] += 1
+        if time.monotonic() >= self.resting_until:
+            self.consecutive_failures += 1
+        return self.throttle.delay(self.consecutive_failures - 1)
+
+    def ready(self, now):
+        return self.inflight < self.throttle.controller.slots and self.resting_until <= now
+
+    def priority(self):
+        """Sort key: healthy shards with tokens and free slots first."""
+        return (self.consecutive_failures, self.throttle.bucket.tokens < 1.0,
+                self.inflight / self.throttle.controller.slots)
+
+    def report(self):
+        return dict(self.stats, name=self.name, concurrency=self.throttle.controller.limit,
+                    consecutive_failures=self.consecutive_failures)
+
+
+class SynthesisEngine:
+    """Synthesize :class:`SynthesisJob` by ``shards`` (:class:`Shard` list).
+
+    Each request goes to the ready shard of the best :meth:`Shard.priority`,
+    and its retries may go to another one.
+    ``progress(job, done, total)`` is called after each finished job.
+    If ``journal`` (:class:`~sphinxcontrib.cache.CacheIndex`) is passed,
+    the start, completion and failure of each job are recorded in it.
+    If ``split(err, text)`` returns a list of SSML documents for a rejected
+    request, they are synthesized one by one and joined into the fragment.
+    API calls, retries, throttles, billed characters, downloaded bytes and
+    latencies are recorded in ``metrics`` (:class:`~sphinxcontrib.metrics.Metrics`).
+    """
+    def __init__(self, shards, progress=None, journal=None, split=None, metrics=None):
+        self.shards = shards
+        self.progress = progress
+        self.journal = journal
+        self.split = split
+        self.metrics = metrics or Metrics()
+        self.results = {}
+        self.failures = {}
+        self.total = 0
+        self._done = 0
+        self._cond = None
+
+    async def _acquire(self):
+        """Wait for a free slot of the best ready shard. Returns ``(shard, epoch)``."""
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            while True:
+                now = time.monotonic()
+                ready = [shard for shard in self.shards if shard.ready(now)]
+                if ready:
+                    shard = min(ready, key=Shard.priority)
+                    shard.inflight += 1
+                    return shard, shard.throttle.controller.epoch
+                resting = [shard.resting_until for shard in self.shards
+                           if shard.resting_until > now]
+                try:
+                    await asyncio.wait_for(self._cond.wait(),
+                                           min(resting) - now if resting else None)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _release(self, shard, epoch, throttled=False, succeeded=False, rest=0.0):
+        async with self._cond:
+            shard.inflight -= 1
+            controller = shard.throttle.controller
+            if throttled:
+                controller.on_throttle(epoch)
+            elif succeeded:
+                controller.on_success()
+            if rest:
+                shard.resting_until = max(shard.resting_until, time.monotonic() + rest)
+            self._cond.notify_all()
+
+    async def _call(self, texts, dests, call):
+        """Run ``await call(client, outputs)`` with retries, where ``outputs`` are
+        :class:`FragmentOutput` of ``dests``. Returns the committed outputs.
+        """
+        metrics = self.metrics
+        attempt = 0
+        while True:
+            shard, epoch = await self._acquire()
+            throttle = shard.throttle
+            wait = throttle.bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            outputs = [FragmentOutput(dest) for dest in dests]
+            metrics.count("api_calls")
+            shard.stats["calls"] += 1
+            start = time.perf_counter()
+            try:
+                await call(shard.client, outputs)
+                for output in outputs:
+                    output.commit()
+            except Exception as err:
+                for output in outputs:
+                    output.discard()
+                throttled, retryable = throttle.classify(err)
+                if throttled:
+                    metrics.count("throttles")
+                    shard.stats["throttles"] += 1
+                    throttle.bucket.drain()
+                await self._release(shard, epoch, throttled=throttled,
+                                    rest=shard.failed() if retryable else 0.0)
+                if not retryable or attempt >= throttle.max_retries:
+                    metrics.count("api_errors")
+                    raise
+                metrics.count("retries")
+                attempt += 1
+            else:
+                metrics.add_time("api_latency", time.perf_counter() - start, sample=True)
+                passes = getattr(shard.client, 'billed_passes', 1)
+                metrics.count("billed_characters",
+                              passes * sum(billed_characters(text) for text in texts))
+                metrics.count("bytes_downloaded", sum(output.size for output in outputs))
+                shard.stats["succeeded"] += 1
+                shard.consecutive_failures = 0
+                await self._release(shard, epoch, succeeded=True)
+                return outputs
+
+    async def _request(self, text, dest):
+        """Synthesize ``text`` into ``dest`` with retries. Returns :class:`FragmentOutput`."""
+        async def call(client, outputs):
+            await client.synthesize(text, outputs[0])
+        outputs = await self._call([text], [dest], call)
+        return outputs[0]
+
+    async def _request_or_split(self, text, dest):
+        """Returns size and checksum of ``dest``."""
+        try:
+            output = await self._request(text, dest)
+            return output.size, output.checksum
+        except Exception as err:
+            parts = self.split(err, text) if self.split else None
+            if not parts or len(parts) < 2:
+                raise
+            # the pieces are named after the journaled temporary file of dest,
+            # so recover() removes them after a crash
+            partpaths = ['%s.%d.split' % (part_path(dest), i) for i in range(len(parts))]
+            try:
+                for part, partpath in zip(parts, partpaths):
+                    await self._request_or_split(part, partpath)
+                mp3.concatenate(partpaths, dest)
+            finally:
+                for partpath in partpaths:
+                    if os.path.exists(partpath):
+                        os.remove(partpath)
+            return os.path.getsize(dest), file_checksum(dest)
+
+    async def _synthesize(self, job):
+        if self.journal:
+            self.journal.start(job.key, part_path(job.dest))
+        with self.metrics.timer("synthesis_latency", sample=True):
+            size, checksum = await self._request_or_split(job.text, job.dest)
+        if self.journal:
+            self.journal.complete(job.key, size, checksum)
+        return size
+
+    async def _worker(self, queue):
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            try:
+                self.results[job.key] = await self._synthesize(job)
+            except Exception as err:
+                self.failures[job.key] = err
+                self.metrics.count("synthesis_failures")
+                if self.journal:
+                    self.journal.fail(job.key, str(err))
+            self._done += 1
+            if self.progress:
+                self.progress(job, self._done, self.total)
+
+    @property
+    def workers(self):
+        # workers are only a bound; the shards decide the real concurrency
+        return sum(shard.throttle.controller.maximum for shard in self.shards)
+
+    async def serve(self, queue):
+        """Synthesize jobs from ``queue`` until each worker receives ``None``."""
+        async with contextlib.AsyncExitStack() as stack:
+            for shard in self.shards:
+                await stack.enter_async_context(shard.client)
+            await asyncio.gather(*[self._worker(queue) for i in range(self.workers)])
+        return self.results, self.failures
+
+    async def run_async(self, jobs):
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+            self.total += 1
+        for i in range(self.workers):
+            queue.put_nowait(None)
+        return await self.serve(queue)
+
+    def run(self, jobs):
+        """Run all jobs and return ``(results, failures)`` keyed by job key."""
+        return asyncio.run(self.run_async(jobs))
+
+
+class BatchSynthesisEngine(SynthesisEngine):
+    """:class:`SynthesisEngine` for clients that synthesize many fragments in one request.
+
+    Each worker takes up to ``batch_size`` queued jobs of at most
+    ``batch_characters`` billed characters in total, and passes them to
+    ``client.synthesize_batch(texts, outputs)``.
+    """
+    def __init__(self, shards, progress=None, journal=None, split=None, metrics=None,
+                 batch_size=100, batch_characters=None):
+        super().__init__(shards, progress, journal, split, metrics)
+        self.batch_size = batch_size
+        self.batch_characters = batch_characters
+
+    def _take_batch(self, queue, first, pending, stop):
+        """Fill a batch from ``first`` and the jobs already in ``queue``.
+
+        A job that doesn't fit is left in ``pending`` for the next batch.
+        Returns ``(batch, stop)``. ``stop`` is true once this worker has
+        taken its end mark, and the queue is not read anymore.
+        """
+        batch = [first]
+        characters = billed_characters(first.text)
+        while len(batch) < self.batch_size:
+            if pending:
+                job = pending.pop()
+            elif not stop and not queue.empty():
+                job = queue.get_nowait()
+            else:
+                break
+            if job is None:
+                return batch, True
+            size = billed_characters(job.text)
+            if self.batch_characters and characters + size > self.batch_characters:
+                pending.append(job)
+                break
+            batch.append(job)
+            characters += size
+        return batch, stop
+
+    async def _synthesize_batch(self, batch):
+        if self.journal:
+            for job in batch:
+                self.journal.start(job.key, part_path(job.dest))
+        texts = [job.text for job in batch]
+
+        async def call(client, outputs):
+            await client.synthesize_batch(texts, outputs)
+        with self.metrics.timer("synthesis_latency", sample=True):
+            outputs = await self._call(texts, [job.dest for job in batch], call)
+        if self.journal:
+            for job, output in zip(batch, outputs):
+                self.journal.complete(job.key, output.size, output.checksum)
+        return [output.size for output in outputs]
+
+    async def _worker(self, queue):
+        pending = []
+        stop = False
+        while not stop or pending:
+            job = pending.pop() if pending else await queue.get()
+            if job is None:
+                return
+            batch, stop = self._take_batch(queue, job, pending, stop)
+            try:
+                for job, size in zip(batch, await self._synthesize_batch(batch)):
+                    self.results[job.key] = size
+            except Exception as err:
+                for job in batch:
+                    self.failures[job.key] = err
+                    if self.journal:
+                        self.journal.fail(job.key, str(err))
+                self.metrics.count("synthesis_failures", len(batch))
+            for job in batch:
+                self._done += 1
+                if self.progress:
+                    self.progress(job, self._done, self.total)
+
+
+class BackgroundSynthesizer:
+    """Run :class:`SynthesisEngine` in a background thread.
+
+    Jobs can be submitted from the main thread while Sphinx is still
+    writing documents. :meth:`join` waits until all of them are done.
+    If the engine fails (e.g. a client can't be created), the error is
+    kept in :attr:`error`, and the unfinished jobs are failures of it.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.submitted = set()
+        self.error = None
+        self._loop = asyncio.new_event_loop()
+        self._queue = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        self._ready.set()
+        try:
+            self._loop.run_until_complete(self.engine.serve(self._queue))
+        except Exception as err:
+            self.error = err
+        finally:
+            self._loop.close()
+
+    def _put(self, job):
+        self._queue.put_nowait(job)
+        if job is not None:
+            self.engine.total += 1
+
+    def submit(self, job):
+        """Queue ``job`` unless the same key is already submitted."""
+        if job.key in self.submitted:
+            return False
+        # a job that can't be queued any more is reported by join()
+        self.submitted.add(job.key)
+        if self.error is not None:
+            return False
+        try:
+            self._loop.call_soon_threadsafe(self._put, job)
+        except RuntimeError:
+            # the loop is closed by the failure of the engine
+            return False
+        return True
+
+    def join(self):
+        """Wait for all submitted jobs and return ``(results, failures)``."""
+        try:
+            for i in range(self.engine.workers):
+                self._loop.call_soon_threadsafe(self._put, None)
+        except RuntimeError:
+            pass
+        self._thread.join()
+        results, failures = self.engine.results, self.engine.failures
+        if self.error is not None:
+            for key in self.submitted - set(results) - set(failures):
+                failures[key] = self.error
+        return results, failures
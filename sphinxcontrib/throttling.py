@@ -1,30 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib.throttling
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Rate limiting and retry scheduling for the Polly API calls.
+
+    * :class:`TokenBucket` keeps sustained request rate under the account quota.
+    * :class:`AIMDController` adapts the number of in-flight requests:
+      it grows additively while calls succeed and shrinks multiplicatively
+      when the service answers with throttling errors.
+    * :func:`backoff_delay` is the "full jitter" exponential backoff.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
 import concurrent.futures
 import random
 import time
 import threading
 
-class Ticker:
-    def __init__(self, rps):
+
+class TokenBucket:
+    """Token bucket. ``rate`` tokens are added per second up to ``burst``.
+
+    ``rate`` of ``None`` or ``0`` disables the limit.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate or 0)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
         self._lock = threading.Lock()
-        self._last = 0
-        self._wait = 1.0 / rps
-
-    def tick(self):
-        self._lock.acquire()
-        now = time.time()
-        wait = max(this._wait - (now - self._last), 0)
-        time.sleep(wait)
-        self._last = now + wait
-        self._lock.release()
-
-def exectasks(rps, tasks, consumer):
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        ticker = Ticker(rps)
-        def exec_task(task):
-            ticker.tick()
-            consumer(task)
-        futures = {executor.submit(consumer, task): task for task in tasks}
-        result = [future.result() for future in concurrent.futures.as_completed(futures)]
-
-    return result
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self):
+        """Take one token and return seconds to wait before it may be used.
+
+        Tokens can go negative: it works as a queue of reservations,
+        so callers are served in order and never starve.
+        """
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1.0
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    @property
+    def tokens(self):
+        """Tokens now. It is negative while reservations are waiting."""
+        if not self.rate:
+            return self.capacity
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def drain(self):
+        """Drop the saved burst. It is called when the service throttles us."""
+        if not self.rate:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0.0)
+
+
+class AIMDController:
+    """Additive-increase/multiplicative-decrease concurrency limit.
+
+    Every request remembers the :attr:`epoch` at its start. Throttling
+    responses of requests that started before the last decrease are
+    ignored, so one burst of rejections halves the limit only once.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=16, increase=1.0, decrease=0.5):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.epoch = 0
+
+    def on_success(self):
+        self.limit = min(float(self.maximum), self.limit + self.increase / self.limit)
+
+    def on_throttle(self, epoch):
+        if epoch != self.epoch:
+            return False
+        self.limit = max(float(self.minimum), self.limit * self.decrease)
+        self.epoch += 1
+        return True
+
+    @property
+    def slots(self):
+        return max(self.minimum, int(self.limit))
+
+
+class ConcurrencyLimiter:
+    """Blocking gate that admits at most ``controller.slots`` callers."""
+    def __init__(self, controller):
+        self.controller = controller
+        self.inflight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.inflight >= self.controller.slots:
+                self._cond.wait()
+            self.inflight += 1
+            return self.controller.epoch
+
+    def release(self, epoch, throttled=False, succeeded=False):
+        with self._cond:
+            self.inflight -= 1
+            if throttled:
+                self.controller.on_throttle(epoch)
+            elif succeeded:
+                self.controller.on_success()
+            self._cond.notify_all()
+
+
+def backoff_delay(attempt, base=0.5, cap=20.0):
+    """Full jitter exponential backoff: uniform(0, min(cap, base * 2 ** attempt))."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def _never(err):
+    return False
+
+
+class Throttle:
+    """Bundle of the scheduling settings shared by the synthesis runners."""
+    def __init__(self, rps, burst=None, concurrency=4, max_concurrency=16,
+                 max_retries=5, backoff_base=0.5, backoff_max=20.0,
+                 is_throttle=None, is_retryable=None):
+        self.bucket = TokenBucket(rps, burst)
+        self.controller = AIMDController(concurrency, 1, max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.is_throttle = is_throttle or _never
+        self.is_retryable = is_retryable or _never
+
+    def classify(self, err):
+        """Return ``(throttled, retryable)`` for the exception."""
+        throttled = self.is_throttle(err)
+        return throttled, throttled or self.is_retryable(err)
+
+    def delay(self, attempt):
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max)
+
+
+def exectasks(rps, tasks, consumer, **options):
+    """Run ``consumer(task)`` for every task under the rate and concurrency limit.
+
+    ``options`` are passed to :class:`Throttle`. Failing tasks are retried
+    while ``is_throttle``/``is_retryable`` accepts the error and
+    ``max_retries`` is not exhausted.
+
+    Returns ``(results, failures)``: dicts from task to the return value
+    and from task to the last exception.
+    """
+    throttle = Throttle(rps, **options)
+    limiter = ConcurrencyLimiter(throttle.controller)
+    results = {}
+    failures = {}
+
+    def exec_task(task):
+        attempt = 0
+        while True:
+            epoch = limiter.acquire()
+            throttle.bucket.acquire()
+            try:
+                result = consumer(task)
+            except Exception as err:
+                throttled, retryable = throttle.classify(err)
+                limiter.release(epoch, throttled=throttled)
+                if throttled:
+                    throttle.bucket.drain()
+                if not retryable or attempt >= throttle.max_retries:
+                    raise
+                time.sleep(throttle.delay(attempt))
+                attempt += 1
+            else:
+                limiter.release(epoch, succeeded=True)
+                return result
+
+    with concurrent.futures.ThreadPoolExecutor(throttle.controller.maximum) as executor:
+        futures = {executor.submit(exec_task, task): task for task in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            task = futures[future]
+            try:
+                results[task] = future.result()
+            except Exception as err:
+                failures[task] = err
+
+    return results, failures
 
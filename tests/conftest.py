@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+    conftest
+    ~~~~~~~~
+
+    The local Polly and S3 stand-in of the benchmarks for the build tests.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import argparse
+from os import path
+import sys
+
+import pytest
+
+BENCHMARKS = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'benchmarks')
+sys.path.insert(0, BENCHMARKS)
+
+import run  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def polly_url():
+    args = argparse.Namespace(latency=0.0, jitter=0.0, quota=0, throttle_rate=0.0,
+                              error_rate=0.0, task_latency=0.0)
+    process, url = run.start_polly(args)
+    yield url
+    process.terminate()
+    process.wait()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+    test_cache
+    ~~~~~~~~~~
+
+    The fragment cache index: builds sharing one directory, recovery of
+    interrupted requests, verification and eviction.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import os
+import time
+
+import pytest
+
+from sphinxcontrib import mp3
+from sphinxcontrib.cache import CacheIndex, file_checksum, synthesis_key
+
+SECONDS_PER_DAY = 86400
+
+
+@pytest.fixture
+def workdir(tmpdir):
+    return str(tmpdir)
+
+
+def add_fragment(index, key, seconds=0.1, last_used=None):
+    """Write the fragment of ``key`` as the synthesizer does and register it."""
+    filepath = index.filepath(key)
+    with open(filepath, 'wb') as f:
+        f.write(mp3.silence(seconds))
+    index.complete(key, os.path.getsize(filepath), file_checksum(filepath))
+    if last_used is not None:
+        with index.lock:
+            index.conn.execute('UPDATE fragments SET last_used = ? WHERE key = ?',
+                               (last_used, key))
+            index.conn.commit()
+    return filepath
+
+
+def test_synthesis_key():
+    key = synthesis_key('<speak>a</speak>', {'voice': 'Joanna'})
+    assert key == synthesis_key('<speak>a</speak>', {'voice': 'Joanna'})
+    assert key != synthesis_key('<speak>a</speak>', {'voice': 'Mizuki'})
+    assert key != synthesis_key('<speak>b</speak>', {'voice': 'Joanna'})
+
+
+def test_index_is_rebuilt_from_the_files(workdir):
+    with open(os.path.join(workdir, 'abc.mp3'), 'wb') as f:
+        f.write(mp3.silence(0.5))
+    index = CacheIndex(workdir)
+    try:
+        assert index.existing(['abc', 'def']) == {'abc'}
+        assert index.verify(['abc']) == {'abc'}
+    finally:
+        index.close()
+
+
+def test_two_builds_share_a_directory(workdir):
+    first = CacheIndex(workdir)
+    add_fragment(first, 'aaaa')
+    first.start('bbbb', first.filepath('bbbb') + '.1.part')
+    open(first.filepath('bbbb') + '.1.part', 'wb').close()
+    second = CacheIndex(workdir)
+    try:
+        assert first.filelock.mode == second.filelock.mode == 'shared'
+        # the request in flight of the first build is not recovered by the second
+        assert os.path.exists(first.filepath('bbbb') + '.1.part')
+        assert second.existing(['aaaa', 'bbbb']) == {'aaaa'}
+        # fragments completed by one build are seen by the other
+        add_fragment(second, 'cccc')
+        assert first.existing(['cccc']) == {'cccc'}
+        # eviction needs the cache for itself
+        assert first.evict(set(), max_size=0) is None
+        assert first.existing(['aaaa', 'cccc']) == {'aaaa', 'cccc'}
+    finally:
+        second.close()
+    try:
+        assert sorted(first.evict(set(), max_size=0)) == ['aaaa', 'cccc']
+        assert first.filelock.mode == 'shared'
+        assert not os.path.exists(first.filepath('aaaa'))
+    finally:
+        first.close()
+
+
+def test_interrupted_requests_are_recovered(workdir):
+    index = CacheIndex(workdir)
+    tmppath = index.filepath('k[1]') + '.42.part'
+    pieces = ['%s.%d.split' % (tmppath, i) for i in range(2)]
+    for filepath in [tmppath] + pieces + [pieces[0] + '.0.split']:
+        open(filepath, 'wb').close()
+    index.start('k[1]', tmppath)
+    index.fail('broken', 'ValidationException')
+    unrelated = index.filepath('other') + '.7.part'
+    open(unrelated, 'wb').close()
+    # the build is killed: the journal keeps the request in flight
+    index.conn.close()
+    index.filelock.release()
+
+    index = CacheIndex(workdir)
+    try:
+        files = [name for name in os.listdir(workdir) if not name.startswith('index.sqlite')]
+        assert sorted(files) == ['lock', os.path.basename(unrelated)]
+        rows = index.conn.execute("SELECT key FROM journal WHERE state = 'inflight'").fetchall()
+        assert rows == []
+        assert index.failed() == {'broken': 'ValidationException'}
+    finally:
+        index.close()
+
+
+def test_verify_drops_changed_files(workdir):
+    index = CacheIndex(workdir)
+    try:
+        same = add_fragment(index, 'same')
+        changed = add_fragment(index, 'changed')
+        add_fragment(index, 'missing')
+        os.remove(index.filepath('missing'))
+        # restored by CI: the same content with a new mtime
+        os.utime(same, (time.time() + 10, time.time() + 10))
+        with open(changed, 'r+b') as f:
+            f.seek(100)
+            f.write(b'\x01')
+        assert index.verify(['same', 'changed', 'missing']) == {'same'}
+        assert index.existing(['same', 'changed', 'missing']) == {'same'}
+        assert not os.path.exists(changed)
+    finally:
+        index.close()
+
+
+def test_eviction_order(workdir):
+    now = time.time()
+    index = CacheIndex(workdir)
+    try:
+        size = os.path.getsize(add_fragment(index, 'newest', last_used=now))
+        add_fragment(index, 'old', last_used=now - 10 * SECONDS_PER_DAY)
+        add_fragment(index, 'older', last_used=now - 20 * SECONDS_PER_DAY)
+        add_fragment(index, 'oldest', last_used=now - 30 * SECONDS_PER_DAY)
+        add_fragment(index, 'protected', last_used=now - 40 * SECONDS_PER_DAY)
+        protected = {'protected'}
+        # least recently used first, down to the size
+        assert index.eviction_candidates(protected, 3 * size) == ['oldest', 'older']
+        # unused for the days
+        assert index.eviction_candidates(protected, None, 15) == ['oldest', 'older']
+        assert index.eviction_candidates(protected, 2 * size, 15) == \
+            ['oldest', 'older', 'old']
+        assert index.eviction_candidates(protected) == []
+
+        assert index.evict(protected, max_age=25) == ['oldest']
+        assert index.existing(['oldest', 'older']) == {'older'}
+        assert not os.path.exists(index.filepath('oldest'))
+    finally:
+        index.close()
+
+
+def test_touch_keeps_fragments(workdir):
+    index = CacheIndex(workdir)
+    try:
+        add_fragment(index, 'used', last_used=time.time() - 30 * SECONDS_PER_DAY)
+        add_fragment(index, 'unused', last_used=time.time() - 30 * SECONDS_PER_DAY)
+        index.touch(['used'])
+        assert index.eviction_candidates(set(), None, 15) == ['unused']
+    finally:
+        index.close()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+    test_chunker
+    ~~~~~~~~~~~~
+
+    Fragment boundaries of :mod:`sphinxcontrib.chunker`.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import random
+import re
+from xml.sax.saxutils import escape
+
+import pytest
+
+from sphinxcontrib.cache import synthesis_key
+from sphinxcontrib.chunker import (
+    JOIN_AFTER, JOIN_BEFORE, MAX_REQUEST_CHARACTERS, REGULAR, Chunker, _split_long_items,
+    billed_characters, chunk, join_ssml, split_sentences, split_ssml)
+
+WORDS = 'alpha beta gamma delta epsilon zeta theta iota kappa lambda sigma omega'.split()
+
+
+def text(value, flag=REGULAR):
+    return [len(value), flag, value]
+
+
+def markup(value, flag=REGULAR):
+    return [0, flag, value]
+
+
+def sentences(count, seed=1):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for i in range(rng.randint(5, 20))).capitalize() + '. '
+            for i in range(count)]
+
+
+def emitted(limit, items, max_request=MAX_REQUEST_CHARACTERS, anchor=None):
+    """``(count, text, index, final)`` of each fragment."""
+    result = []
+    chunker = Chunker(limit, lambda *fragment: result.append(fragment), max_request, anchor)
+    for item in items:
+        chunker.add(*item)
+    chunker.finish()
+    return result
+
+
+def test_split_sentences():
+    assert split_sentences('One. Two? Three, four; five: six') == \
+        ['One. ', 'Two? ', 'Three, ', 'four; ', 'five: ', 'six']
+    # no boundary inside numbers and abbreviations without a space
+    assert split_sentences('Pi is 3.14, e.g.: 2.71.') == ['Pi is 3.14, ', 'e.g.: ', '2.71.']
+    assert split_sentences('文です。次です、終わり') == ['文です。', '次です、', '終わり']
+    assert split_sentences('') == []
+
+
+def test_billed_characters():
+    assert billed_characters('<speak><break time="1s"/>a &amp; b</speak>') == 5
+
+
+def test_fragments_are_numbered_and_only_the_last_is_final():
+    fragments = emitted(50, [text(s) for s in sentences(20)])
+    assert len(fragments) > 2
+    assert [index for count, value, index, final in fragments] == \
+        list(range(1, len(fragments) + 1))
+    assert [final for count, value, index, final in fragments] == \
+        [False] * (len(fragments) - 1) + [True]
+
+
+def test_fragments_keep_every_item_and_the_limit():
+    items = [text(s) for s in sentences(200)]
+    fragments = chunk(items, 300)
+    assert ''.join(value for count, value in fragments) == ''.join(item[2] for item in items)
+    for count, value in fragments:
+        assert count == len(value) <= 300
+
+
+def test_cut_at_the_best_boundary_that_fills_half():
+    items = [text('a' * 38 + '. '), text('b' * 28 + ', '), text('c' * 19 + ' '),
+             text('d' * 40)]
+    # the sentence end leaves the fragment less than half full, the clause end doesn't
+    assert chunk(items, 100) == [(70, items[0][2] + items[1][2]),
+                                 (60, items[2][2] + items[3][2])]
+
+
+def test_break_is_preferred_to_sentence_end():
+    items = [text('a' * 58 + '. '), markup('<break time="1s" />'), text('b' * 18 + '. '),
+             text('c' * 40)]
+    fragments = chunk(items, 100)
+    assert fragments[0] == (60, items[0][2] + items[1][2])
+
+
+def test_cut_at_the_latest_boundary_if_none_fills_half():
+    items = [text('a' * 10 + '. '), text('b' * 10 + ' '), text('c' * 95)]
+    fragments = chunk(items, 100)
+    assert fragments == [(23, items[0][2] + items[1][2]), (95, items[2][2])]
+
+
+def test_join_flags_keep_the_title_together():
+    # the markup of a section title, as SSMLTranslator adds it
+    title = [markup('<break time="2000ms" />', JOIN_AFTER),
+             markup('<emphasis level="strong">', JOIN_AFTER),
+             text('Title of the section'),
+             markup('</emphasis>', JOIN_BEFORE),
+             markup('<break time="2000ms" />', JOIN_BEFORE)]
+    items = []
+    for i, sentence in enumerate(sentences(60)):
+        items.append(text(sentence))
+        if i % 4 == 3:
+            items.extend(title)
+    for count, value in chunk(items, 120):
+        # no cut inside <emphasis>, nor between a title and its breaks
+        assert value.count('<emphasis') == value.count('</emphasis>')
+        if 'Title' in value:
+            assert '<break time="2000ms" /><emphasis level="strong">Title of the section' \
+                   '</emphasis><break time="2000ms" />' in value
+
+
+def test_no_cut_inside_a_long_emphasis():
+    items = [text('before. '), markup('<emphasis level="moderate">', JOIN_AFTER)]
+    items.extend(text(sentence) for sentence in sentences(10))
+    items.extend([markup('</emphasis>', JOIN_BEFORE), text('after. ')])
+    fragments = chunk(items, 100)
+    emphasis = [value for count, value in fragments if '<emphasis' in value]
+    # the element overflows the limit rather than being cut
+    assert len(emphasis) == 1 and emphasis[0].endswith('</emphasis>')
+
+
+def test_split_long_items():
+    sentence = 'word ' * 30 + 'x' * 25 + ' &amp; end'
+    item = [len('word ' * 30 + 'x' * 25 + ' & end'), JOIN_BEFORE, sentence]
+    pieces = list(_split_long_items([text('short. '), item], 20))
+    assert pieces[0] == text('short. ')
+    assert ''.join(piece[2] for piece in pieces[1:]) == sentence
+    for count, flag, value in pieces[1:]:
+        assert 0 < count <= 20
+        assert count == len(value.replace('&amp;', '&'))
+    # a word longer than the limit is cut hard
+    assert 'x' * 20 in [piece[2] for piece in pieces]
+    # the flag stays with the last piece
+    assert [piece[1] for piece in pieces[1:]] == [REGULAR] * (len(pieces) - 2) + [JOIN_BEFORE]
+
+
+def test_add_splits_long_items():
+    long_sentence = 'spoken words ' * 50
+    fragments = chunk([text(long_sentence)], 100)
+    assert ''.join(value for count, value in fragments) == long_sentence
+    assert all(count <= 100 for count, value in fragments)
+
+
+def test_max_request_guard():
+    # markup heavy content: few spoken characters, long request
+    items = []
+    for i in range(100):
+        items.append(text('word%02d ' % i))
+        items.append(markup('<prosody volume="loud" rate="slow" pitch="high">'))
+        items.append(markup('</prosody>'))
+    fragments = chunk(items, 3000, max_request=500)
+    assert len(fragments) > 1
+    for count, value in fragments:
+        assert len(value) <= 500
+
+
+def test_add_text_is_add_of_each_escaped_piece():
+    raw = 'Tom & Jerry <cartoon>. It runs, and runs; ' + 'then stops. ' * 30
+    by_text, by_item = [], []
+    chunker = Chunker(100, lambda *fragment: by_text.append(fragment), anchor=50)
+    chunker.add_text(raw)
+    chunker.finish()
+    chunker = Chunker(100, lambda *fragment: by_item.append(fragment), anchor=50)
+    for piece in split_sentences(raw):
+        chunker.add(len(piece), REGULAR, escape(piece))
+    chunker.finish()
+    assert by_text == by_item
+    assert by_text[0][1].startswith('Tom &amp; Jerry &lt;cartoon&gt;. ')
+
+
+def test_finish_starts_over():
+    result = []
+    chunker = Chunker(100, lambda *fragment: result.append(fragment))
+    chunker.add(*text('first. '))
+    chunker.finish()
+    chunker.finish()
+    chunker.add(*text('second. '))
+    chunker.finish()
+    assert result == [(7, 'first. ', 1, True), (8, 'second. ', 1, True)]
+
+
+def keys(items, anchor):
+    return [synthesis_key('<speak>%s</speak>' % value, {})
+            for count, value in chunk(items, 3000, anchor=anchor)]
+
+
+@pytest.mark.parametrize('position', [70, 210, 350, 490])
+def test_inserted_sentence_changes_one_fragment(position):
+    section = sentences(600)
+    before = keys([text(s) for s in section], 1500)
+    edited = section[:position] + ['One more sentence is inserted here. '] + section[position:]
+    after = keys([text(s) for s in edited], 1500)
+    assert len(set(before) - set(after)) == 1
+    assert len(set(after) - set(before)) == 1
+
+
+SSML = ('<speak xml:lang="en-US"><prosody rate="slow">'
+        '<break time="1000ms" />First sentence here. Second one, with a clause. '
+        'Third &amp; last sentence.</prosody></speak>')
+
+
+def test_split_ssml():
+    documents = split_ssml(SSML)
+    assert len(documents) >= 2
+    head, tail = '<speak xml:lang="en-US"><prosody rate="slow">', '</prosody></speak>'
+    bodies = []
+    for document in documents:
+        assert document.startswith(head) and document.endswith(tail)
+        bodies.append(document[len(head):-len(tail)])
+    assert ''.join(bodies) == SSML[len(head):-len(tail)]
+    # pieces of about half size
+    counts = [billed_characters(document) for document in documents]
+    assert max(counts) <= (sum(counts) + 1) // 2
+
+
+@pytest.mark.parametrize('ssml', ['<speak>a</speak>', '<speak><break time="1s" /></speak>',
+                                  'not SSML'])
+def test_split_ssml_that_can_not_be_split(ssml):
+    assert split_ssml(ssml) == [ssml]
+
+
+def test_join_ssml():
+    documents = ['<speak xml:lang="en-US">one</speak>', '<speak xml:lang="en-US">two</speak>']
+    assert join_ssml(documents) == \
+        '<speak xml:lang="en-US"><mark name="0"/>one<mark name="1"/>two</speak>'
+    joined = join_ssml(split_ssml(SSML))
+    assert re.sub('<mark name="[0-9]+"/>', '', joined) == SSML
+
+
+def test_join_ssml_of_different_settings():
+    with pytest.raises(ValueError):
+        join_ssml(['<speak xml:lang="en-US">one</speak>', '<speak xml:lang="ja-JP">two</speak>'])
+    with pytest.raises(ValueError):
+        join_ssml(['<speak>one</speak>', 'two'])
+
+
+def test_fragments_of_the_writer_are_well_formed():
+    # every fragment of a long mixed section parses as a speak element
+    items = []
+    for i, sentence in enumerate(sentences(300, seed=3)):
+        items.append(text(sentence))
+        if i % 5 == 4:
+            items.append(markup('<break time="1000ms" />', JOIN_BEFORE))
+    for count, value in chunk(items, 500, anchor=250):
+        assert re.fullmatch(r'(?:<[^<>]+>|[^<>]+)*', value)
+        assert count == billed_characters(value)
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+    test_mp3
+    ~~~~~~~~
+
+    The MPEG audio frame parser and the concatenator of known frames.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import os
+import struct
+
+import pytest
+
+from sphinxcontrib import mp3
+
+# MPEG 2 layer III, 48kbps, 22050Hz, mono: the frames of mp3.silence()
+SILENCE_HEADER = mp3.parse_header(mp3.silence(0.1)[:4])
+FRAME_SECONDS = 576 / 22050
+
+
+@pytest.mark.parametrize('data, version, layer, bitrate, sample_rate, length', [
+    (b'\xff\xfb\x90\x00', mp3.MPEG1, 3, 128, 44100, 417),
+    (b'\xff\xfb\x92\x00', mp3.MPEG1, 3, 128, 44100, 418),
+    (b'\xff\xf3\x60\xc0', mp3.MPEG2, 3, 48, 22050, 156),
+    (b'\xff\xe3\x60\xc0', mp3.MPEG25, 3, 48, 11025, 313),
+    (b'\xff\xfd\x80\x00', mp3.MPEG1, 2, 128, 44100, 417),
+    (b'\xff\xff\x18\x00', mp3.MPEG1, 1, 32, 32000, 48),
+])
+def test_parse_header(data, version, layer, bitrate, sample_rate, length):
+    header = mp3.parse_header(data)
+    assert (header.version, header.layer, header.bitrate, header.sample_rate) == \
+        (version, layer, bitrate, sample_rate)
+    assert header.length == length
+
+
+@pytest.mark.parametrize('data', [
+    b'\xff\xfb\x90',      # too short
+    b'ID3\x03',           # no frame sync
+    b'\xff\xeb\x90\x00',  # reserved version
+    b'\xff\xf9\x90\x00',  # reserved layer
+    b'\xff\xfb\x00\x00',  # free bitrate
+    b'\xff\xfb\xf0\x00',  # bad bitrate
+    b'\xff\xfb\x9c\x00',  # reserved sample rate
+])
+def test_parse_header_rejects(data):
+    assert mp3.parse_header(data) is None
+
+
+def test_is_info_frame():
+    info = mp3.xing_frame(SILENCE_HEADER, [156] * 4, False)
+    assert mp3.is_info_frame(info, mp3.parse_header(info[:4]))
+    silence = mp3.silence(0.1)
+    assert not mp3.is_info_frame(silence[:156], SILENCE_HEADER)
+    # a CRC after the header moves the tag by 2 bytes
+    protected = bytearray(156)
+    protected[0:4] = b'\xff\xf2\x60\xc0'
+    protected[4 + 9 + 2:4 + 9 + 6] = b'Info'
+    assert mp3.is_info_frame(bytes(protected), mp3.parse_header(protected[:4]))
+    vbri = bytearray(silence[:156])
+    vbri[36:40] = b'VBRI'
+    assert mp3.is_info_frame(bytes(vbri), SILENCE_HEADER)
+
+
+def audio_range(frames, start=50):
+    audio = mp3.AudioRange()
+    audio.start = start
+    audio.header = SILENCE_HEADER
+    audio.sizes.extend([100] * frames)
+    audio.end = start + 100 * frames
+    return audio
+
+
+def test_split_ranges():
+    audio = audio_range(10)
+    ranges = mp3.split_ranges(audio, [0.0, 3 * FRAME_SECONDS, 7.4 * FRAME_SECONDS])
+    assert ranges == [(50, 350), (350, 750), (750, 1050)]
+
+
+def test_split_ranges_clamps_times():
+    audio = audio_range(10)
+    # a mark before the previous one and a mark after the end
+    ranges = mp3.split_ranges(audio, [0.0, 5 * FRAME_SECONDS, 2 * FRAME_SECONDS,
+                                      20 * FRAME_SECONDS])
+    assert ranges == [(50, 550), (550, 550), (550, 1050), (1050, 1050)]
+
+
+def test_split_ranges_without_audio():
+    assert mp3.split_ranges(audio_range(10), []) == []
+    empty = mp3.AudioRange()
+    empty.start = empty.end = 0
+    assert mp3.split_ranges(empty, [0.0, 1.0]) == [(0, 0), (0, 0)]
+
+
+def test_id3v2_tag():
+    tag = mp3.id3v2_tag({'title': 'Ünïcode', 'track': 3, 'album': '', 'author': None})
+    title = b'\x01' + 'Ünïcode'.encode('utf-16')
+    track = b'\x01' + '3'.encode('utf-16')
+    body = (b'TIT2' + struct.pack('>IH', len(title), 0) + title +
+            b'TRCK' + struct.pack('>IH', len(track), 0) + track)
+    assert tag == b'ID3\x03\x00\x00' + bytes([0, 0, 0, len(body)]) + body
+    assert title[1:3] in (b'\xff\xfe', b'\xfe\xff')
+
+
+def test_id3v2_tag_sizes():
+    title = 'x' * 300
+    tag = mp3.id3v2_tag({'title': title})
+    assert mp3.id3v2_size(tag) == len(tag)
+    # the tag size is syncsafe, the frame size of ID3v2.3 is a plain integer
+    assert tag[6:10] == bytes([0, 0, (len(tag) - 10) >> 7, (len(tag) - 10) & 0x7f])
+    assert struct.unpack('>I', tag[14:18])[0] == 1 + len(title.encode('utf-16'))
+
+
+def test_xing_frame():
+    sizes = [156] * 9 + [157]
+    frame = mp3.xing_frame(SILENCE_HEADER, sizes, True)
+    header = mp3.parse_header(frame[:4])
+    # the smallest bitrate that holds the fields and the TOC
+    assert header.bitrate == 40
+    assert len(frame) == header.length
+    assert (header.version, header.sample_rate, header.channel_mode) == \
+        (SILENCE_HEADER.version, SILENCE_HEADER.sample_rate, SILENCE_HEADER.channel_mode)
+    offset = 4 + 9
+    assert frame[offset:offset + 4] == b'Xing'
+    flags, frames, size = struct.unpack('>III', frame[offset + 4:offset + 16])
+    assert (flags, frames, size) == (7, 10, len(frame) + sum(sizes))
+    toc = frame[offset + 16:offset + 116]
+    assert toc[0] == len(frame) * 256 // size
+    assert toc[10] == (len(frame) + 156) * 256 // size
+    assert list(toc) == sorted(toc)
+    assert mp3.xing_frame(SILENCE_HEADER, sizes, False)[offset:offset + 4] == b'Info'
+
+
+def write(tmpdir, name, data):
+    filepath = str(tmpdir.join(name))
+    with open(filepath, 'wb') as f:
+        f.write(data)
+    return filepath
+
+
+def test_scan_skips_tag_and_info_frame(tmpdir):
+    audio = mp3.silence(0.5)
+    prefix = mp3.id3v2_tag({'title': 'old'}) + mp3.xing_frame(SILENCE_HEADER, [156] * 20, False)
+    with open(write(tmpdir, 'a.mp3', prefix + audio), 'rb') as f:
+        result = mp3.scan(f)
+    assert (result.start, result.end) == (len(prefix), len(prefix) + len(audio))
+    assert len(result.sizes) == len(audio) // 156
+
+
+def copy(tmpdir, data, start, count):
+    source = write(tmpdir, 'source', data)
+    dest = str(tmpdir.join('dest'))
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        dst.write(b'head')
+        dst.flush()
+        mp3._copy_range(src, dst, start, count)
+    with open(dest, 'rb') as f:
+        return f.read()
+
+
+DATA = bytes(range(256)) * 1000
+
+
+def test_copy_range(tmpdir):
+    assert copy(tmpdir, DATA, 1000, 100000) == b'head' + DATA[1000:101000]
+
+
+def test_copy_range_falls_back_to_sendfile(tmpdir, monkeypatch):
+    if not hasattr(os, 'sendfile'):
+        pytest.skip('no os.sendfile')
+    monkeypatch.delattr(os, 'copy_file_range', raising=False)
+    calls = []
+    sendfile = os.sendfile
+
+    def counted(*args):
+        calls.append(args)
+        return sendfile(*args)
+    monkeypatch.setattr(os, 'sendfile', counted)
+    assert copy(tmpdir, DATA, 1000, 100000) == b'head' + DATA[1000:101000]
+    assert calls
+
+
+def test_copy_range_falls_back_to_read_and_write(tmpdir, monkeypatch):
+    def unsupported(*args):
+        raise OSError('not supported')
+    monkeypatch.setattr(os, 'copy_file_range', unsupported, raising=False)
+    assert copy(tmpdir, DATA, 1000, 100000) == b'head' + DATA[1000:101000]
+    monkeypatch.delattr(os, 'copy_file_range')
+    monkeypatch.delattr(os, 'sendfile', raising=False)
+    assert copy(tmpdir, DATA, 3, 200000) == b'head' + DATA[3:200003]
+
+
+def test_copy_range_continues_a_partial_copy(tmpdir, monkeypatch):
+    # the kernel copies a part and gives up
+    def partial(src, dst, count, offset):
+        if offset >= 1010:
+            return 0
+        os.write(dst, os.pread(src, 10, offset))
+        return 10
+    monkeypatch.setattr(os, 'copy_file_range', partial, raising=False)
+    assert copy(tmpdir, DATA, 1000, 5000) == b'head' + DATA[1000:6000]
+
+
+def test_copy_range_detects_short_source(tmpdir, monkeypatch):
+    monkeypatch.delattr(os, 'copy_file_range', raising=False)
+    monkeypatch.delattr(os, 'sendfile', raising=False)
+    with pytest.raises(IOError):
+        copy(tmpdir, DATA[:100], 0, 200)
+
+
+@pytest.mark.parametrize('kernel_copy', [True, False])
+def test_concatenate(tmpdir, monkeypatch, kernel_copy):
+    if not kernel_copy:
+        monkeypatch.delattr(os, 'copy_file_range', raising=False)
+        monkeypatch.delattr(os, 'sendfile', raising=False)
+    first = mp3.silence(0.5)
+    second = mp3.silence(0.3)
+    # per-fragment tags and Info frames are dropped
+    prefix = mp3.id3v2_tag({'title': 'fragment'}) + mp3.xing_frame(SILENCE_HEADER, [156] * 20,
+                                                                   False)
+    sources = [write(tmpdir, 'a.mp3', prefix + first), write(tmpdir, 'b.mp3', second),
+               write(tmpdir, 'empty.mp3', b'')]
+    dest = str(tmpdir.join('out.mp3'))
+    metadata = {'title': 'Chapter 1', 'album': 'Book'}
+    seconds = mp3.concatenate(sources, dest, metadata)
+
+    frames = (len(first) + len(second)) // 156
+    assert seconds == pytest.approx(frames * FRAME_SECONDS)
+    tag = mp3.id3v2_tag(metadata)
+    info = mp3.xing_frame(SILENCE_HEADER, [156] * frames, False)
+    with open(dest, 'rb') as f:
+        data = f.read()
+    assert data == tag + info + first + second
+    assert mp3.id3v2_size(data) == len(tag)
+    offset = len(tag) + 4 + 9
+    assert data[offset:offset + 4] == b'Info'
+    assert struct.unpack('>III', data[offset + 4:offset + 16]) == \
+        (7, frames, len(info) + len(first) + len(second))
+    assert mp3.duration(dest) == pytest.approx(seconds)
+    assert not [name for name in os.listdir(str(tmpdir)) if name.endswith('.part')]
+
+
+def test_concatenate_marks_variable_bitrate(tmpdir):
+    sources = [write(tmpdir, 'a.mp3', mp3.silence(0.2)),
+               write(tmpdir, 'b.mp3', mp3.silence(0.2, bitrate=64))]
+    dest = str(tmpdir.join('out.mp3'))
+    mp3.concatenate(sources, dest)
+    with open(dest, 'rb') as f:
+        data = f.read()
+    offset = mp3.id3v2_size(data) + 4 + 9
+    assert data[offset:offset + 4] == b'Xing'
+
+
+def test_concatenate_rejects_other_sample_rates(tmpdir):
+    sources = [write(tmpdir, 'a.mp3', mp3.silence(0.2)),
+               write(tmpdir, 'b.mp3', mp3.silence(0.2, sample_rate=16000))]
+    dest = str(tmpdir.join('out.mp3'))
+    with pytest.raises(ValueError):
+        mp3.concatenate(sources, dest)
+    assert not os.path.exists(dest)
+    assert not [name for name in os.listdir(str(tmpdir)) if name.endswith('.part')]
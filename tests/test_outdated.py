@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    test_outdated
+    ~~~~~~~~~~~~~
+
+    Documents that Sphinx rewrites get fresh SSML, even if their source
+    digest is unchanged.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import glob
+import os
+from os import path
+import subprocess
+import sys
+
+CONF = '''
+project = 'Outdated'
+master_doc = 'index'
+extensions = ['sphinxcontrib.ssmlbuilder']
+rst_epilog = '.. |who| replace:: %s'
+'''
+
+INDEX = '''Index
+=====
+
+Hello |who|.
+
+.. toctree::
+
+   child
+'''
+
+CHILD = '''%s
+=====
+
+Child of |who|.
+'''
+
+
+def write(root, name, text):
+    with open(path.join(root, name), 'w') as f:
+        f.write(text)
+
+
+def build(root, *options):
+    # the audio output folder is relative to the working directory
+    subprocess.run([sys.executable, '-m', 'sphinx', '-b', 'ssml', '-q'] + list(options) +
+                   ['.', path.join('_build', 'ssml')], cwd=root, check=True)
+
+
+def read_ssml(root, docname):
+    texts = []
+    for filename in sorted(glob.glob(path.join(root, '_build', 'ssml', docname + '*.ssml'))):
+        with open(filename) as f:
+            texts.append(f.read())
+    assert texts
+    return ''.join(texts)
+
+
+def test_config_and_title_changes_are_written(tmpdir):
+    root = str(tmpdir)
+    write(root, 'conf.py', CONF % 'Alice')
+    write(root, 'index.rst', INDEX)
+    write(root, 'child.rst', CHILD % 'Chapter')
+    build(root)
+    assert 'Alice' in read_ssml(root, 'index')
+    assert 'Chapter' in read_ssml(root, 'index')
+
+    # Sphinx rewrites every document for a changed config
+    write(root, 'conf.py', CONF % 'Bob')
+    build(root)
+    for docname in ('index', 'child'):
+        ssml = read_ssml(root, docname)
+        assert 'Bob' in ssml and 'Alice' not in ssml
+
+    # and the parent of a document whose title is changed
+    write(root, 'child.rst', CHILD % 'Episode')
+    build(root)
+    ssml = read_ssml(root, 'index')
+    assert 'Episode' in ssml and 'Chapter' not in ssml
+
+
+def test_forced_rebuild_writes_every_document(tmpdir):
+    root = str(tmpdir)
+    write(root, 'conf.py', CONF % 'Alice')
+    write(root, 'index.rst', INDEX)
+    write(root, 'child.rst', CHILD % 'Chapter')
+    build(root)
+    # stale fragment files are replaced even if the source is unchanged
+    for filename in glob.glob(path.join(root, '_build', 'ssml', '*.ssml')):
+        os.remove(filename)
+    build(root, '-a')
+    assert 'Alice' in read_ssml(root, 'index')
+    assert 'Alice' in read_ssml(root, 'child')
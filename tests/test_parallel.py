@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+    test_parallel
+    ~~~~~~~~~~~~~
+
+    ``-j 2`` builds must write the same SSML, manifests and MP3 files as
+    serial builds. Both build a generated project against the local Polly
+    stand-in of the benchmarks, so no AWS account is needed.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+from os import path
+
+import corpus
+import run
+
+CORPUS = {'docs': 6, 'sections': 3, 'paragraphs': 3, 'sentences': 4, 'tables': 1,
+          'code_blocks': 1}
+
+
+def build(workdir, polly_url, jobs):
+    project = path.join(str(workdir), 'j%d' % jobs)
+    corpus.generate(project, **CORPUS)
+    result = run.run_build(project, polly_url, jobs, path.join(str(workdir), 'j%d.log' % jobs))
+    assert result['failed'] == 0
+    assert result['synthesized'] > 0
+    return project
+
+
+def test_parallel_output_is_identical_to_serial(tmpdir, polly_url):
+    serial = build(tmpdir, polly_url, 1)
+    parallel = build(tmpdir, polly_url, 2)
+    for folder in (path.join('_build', 'ssml'), 'polly'):
+        assert run.compare_trees(path.join(serial, folder), path.join(parallel, folder)) == []
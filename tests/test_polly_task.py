@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+    test_polly_task
+    ~~~~~~~~~~~~~~~
+
+    ``ssml_tts_backend = 'polly-task'`` builds against the local Polly and
+    S3 stand-in of the benchmarks.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+from os import path
+
+import corpus
+import run
+
+CORPUS = {'docs': 3, 'sections': 2, 'paragraphs': 3, 'sentences': 4, 'tables': 0,
+          'code_blocks': 0}
+
+
+def test_polly_task_build(tmpdir, polly_url):
+    project = str(tmpdir.join('project'))
+    docnames = corpus.generate(project, **CORPUS)
+    result = run.run_build(project, polly_url, 1, str(tmpdir.join('build.log')), 'polly-task')
+    assert result['failed'] == 0
+    assert result['synthesized'] == result['fragments'] > 0
+    # a few tasks instead of one request per fragment
+    assert result['counters']['api_calls'] < result['synthesized']
+    # the audio and the speech marks tasks are both billed
+    assert result['counters']['billed_characters'] == result['api_characters']
+    for docname in docnames:
+        assert path.getsize(path.join(project, 'polly', docname + '.mp3')) > 0
+
+    # all fragments are cached, so a no-op build sends nothing
+    result = run.run_build(project, polly_url, 1, str(tmpdir.join('build.log')), 'polly-task')
+    assert result['synthesized'] == 0
+    assert result['api_requests'] == 0
+
+
+def test_polly_task_cache_keys_differ_from_polly(tmpdir, polly_url):
+    project = str(tmpdir.join('project'))
+    corpus.generate(project, **CORPUS)
+    log = str(tmpdir.join('build.log'))
+    first = run.run_build(project, polly_url, 1, log, 'polly')
+    # task audio is cut at the speech marks, so SynthesizeSpeech audio isn't reused
+    second = run.run_build(project, polly_url, 1, log, 'polly-task')
+    assert second['synthesized'] == first['synthesized']
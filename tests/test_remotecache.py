@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    test_remotecache
+    ~~~~~~~~~~~~~~~~
+
+    Fragments go through the S3 remote cache of the local Polly and S3
+    stand-in of the benchmarks from one build to another.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import io
+from os import path
+
+import corpus
+import run
+
+from sphinxcontrib.remotecache import S3Cache
+
+CORPUS = {'docs': 3, 'sections': 2, 'paragraphs': 3, 'sentences': 4, 'tables': 0,
+          'code_blocks': 0}
+
+
+def project_with_remote_cache(workdir, name, polly_url):
+    project = path.join(str(workdir), name)
+    corpus.generate(project, **CORPUS)
+    with open(path.join(project, 'conf.py'), 'a') as f:
+        f.write('ssml_remote_cache = "s3://remote/fragments"\n'
+                'ssml_remote_cache_endpoint_url = %r\n' % polly_url)
+    return project
+
+
+def test_fragments_round_trip_through_s3(tmpdir, polly_url):
+    log = str(tmpdir.join('build.log'))
+    first = project_with_remote_cache(tmpdir, 'first', polly_url)
+    result = run.run_build(first, polly_url, 1, log)
+    assert result['synthesized'] > 0
+    assert result['counters']['remote_uploads'] == result['synthesized']
+
+    # another checkout with an empty local cache downloads every fragment
+    second = project_with_remote_cache(tmpdir, 'second', polly_url)
+    result = run.run_build(second, polly_url, 1, log)
+    assert result['synthesized'] == 0
+    assert result['api_requests'] == 0
+    assert result['counters']['remote_hits'] == result['fragments']
+    assert run.compare_trees(path.join(first, 'polly'), path.join(second, 'polly')) == []
+
+
+def test_s3_cache(tmpdir, polly_url, monkeypatch):
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(name, 'test')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    cache = S3Cache('remote', 'unit/', polly_url)
+    keys = ['ab%02d' % i for i in range(4)] + ['cd00']
+    for key in keys[:3] + keys[4:]:
+        source = tmpdir.join(key)
+        source.write_binary(key.encode() * 100)
+        cache.store(key, str(source))
+    # "ab" is listed, "cd" is checked one by one
+    assert cache.exists(keys) == set(keys) - {'ab03'}
+    output = io.BytesIO()
+    cache.fetch('ab01', output)
+    assert output.getvalue() == b'ab01' * 100
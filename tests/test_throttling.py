@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+    test_throttling
+    ~~~~~~~~~~~~~~~
+
+    Token bucket, AIMD concurrency and backoff of
+    :mod:`sphinxcontrib.throttling` on a fake clock.
+
+    :copyright: Copyright 2017- by Yoshiki Shibukawa.
+    :license: BSD, see LICENSE.txt for details.
+"""
+
+import random
+import threading
+
+import pytest
+
+from sphinxcontrib import throttling
+from sphinxcontrib.throttling import (
+    AIMDController, ConcurrencyLimiter, TokenBucket, backoff_delay, exectasks)
+
+
+class FakeClock:
+    """``time`` of the throttling module: sleeping moves the clock forward."""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttling, 'time', clock)
+    return clock
+
+
+def test_burst(clock):
+    bucket = TokenBucket(2, burst=5)
+    assert [bucket.reserve() for i in range(5)] == [0.0] * 5
+    # the reservations after the burst queue up at the rate
+    assert [bucket.reserve() for i in range(3)] == [0.5, 1.0, 1.5]
+    assert bucket.tokens == -3.0
+
+
+def test_burst_defaults_to_one_second_of_rate(clock):
+    assert TokenBucket(8).capacity == 8.0
+    assert TokenBucket(0.5).capacity == 1.0
+
+
+def test_refill(clock):
+    bucket = TokenBucket(2, burst=5)
+    for i in range(7):
+        bucket.reserve()
+    clock.now += 1.0
+    assert bucket.tokens == 0.0
+    clock.now += 1.25
+    assert bucket.tokens == 2.5
+    assert bucket.reserve() == 0.0
+    # refill stops at the burst
+    clock.now += 60.0
+    assert bucket.tokens == 5.0
+
+
+def test_acquire_sleeps_until_the_reservation(clock):
+    bucket = TokenBucket(4, burst=1)
+    bucket.acquire()
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == [0.25, 0.25]
+    assert clock.now == 1000.5
+
+
+def test_drain_drops_the_burst(clock):
+    bucket = TokenBucket(2, burst=5)
+    bucket.drain()
+    assert bucket.tokens == 0.0
+    assert bucket.reserve() == 0.5
+    # reservations already waiting are kept
+    bucket.drain()
+    assert bucket.tokens == -1.0
+
+
+def test_no_rate_limit(clock):
+    bucket = TokenBucket(None)
+    assert [bucket.reserve() for i in range(100)] == [0.0] * 100
+    bucket.drain()
+    assert bucket.tokens == bucket.capacity
+
+
+def test_additive_increase():
+    controller = AIMDController(initial=4, maximum=6)
+    controller.on_success()
+    assert controller.limit == 4.25
+    for i in range(3):
+        controller.on_success()
+    # one more slot after about a window of successes
+    assert controller.slots == 4
+    controller.on_success()
+    assert controller.slots == 5
+    for i in range(100):
+        controller.on_success()
+    assert controller.limit == 6.0
+
+
+def test_multiplicative_decrease():
+    controller = AIMDController(initial=16, maximum=16)
+    epoch = controller.epoch
+    assert controller.on_throttle(epoch)
+    assert controller.limit == 8.0
+    # the other requests of the same burst don't decrease it again
+    assert not controller.on_throttle(epoch)
+    assert controller.limit == 8.0
+    for i in range(10):
+        controller.on_throttle(controller.epoch)
+    assert controller.limit == 1.0
+    assert controller.slots == 1
+
+
+def test_limiter_releases():
+    controller = AIMDController(initial=2, maximum=4)
+    limiter = ConcurrencyLimiter(controller)
+    first = limiter.acquire()
+    second = limiter.acquire()
+    assert limiter.inflight == 2
+    limiter.release(first, throttled=True)
+    assert controller.slots == 1
+    limiter.release(second, throttled=True)
+    assert controller.limit == 1.0
+    limiter.release(limiter.acquire(), succeeded=True)
+    assert controller.limit == 2.0
+    assert limiter.inflight == 0
+
+
+@pytest.mark.parametrize('attempt, bound', [
+    (0, 0.5), (1, 1.0), (2, 2.0), (5, 16.0), (6, 20.0), (30, 20.0),
+])
+def test_backoff_bounds(monkeypatch, attempt, bound):
+    monkeypatch.setattr(throttling.random, 'uniform', lambda low, high: (low, high))
+    assert backoff_delay(attempt) == (0, bound)
+
+
+def test_backoff_jitter():
+    random.seed(1)
+    delays = [backoff_delay(4, base=0.5, cap=20.0) for i in range(1000)]
+    assert all(0 <= delay <= 8.0 for delay in delays)
+    # full jitter spreads over the whole range
+    assert min(delays) < 1.0 and max(delays) > 7.0
+
+
+class Throttled(Exception):
+    pass
+
+
+def test_exectasks_retries_throttled_tasks(clock, monkeypatch):
+    monkeypatch.setattr(throttling.random, 'uniform', lambda low, high: high)
+    attempts = {}
+    lock = threading.Lock()
+
+    def consumer(task):
+        with lock:
+            attempts[task] = attempts.get(task, 0) + 1
+            if attempts[task] <= task:
+                raise Throttled(task)
+        return task * 10
+
+    results, failures = exectasks(0, range(4), consumer, concurrency=1, max_concurrency=1,
+                                  max_retries=2, is_throttle=lambda err: isinstance(err, Throttled))
+    assert results == {0: 0, 1: 10, 2: 20}
+    assert list(failures) == [3] and isinstance(failures[3], Throttled)
+    assert attempts == {0: 1, 1: 2, 2: 3, 3: 3}
+    # the backoff of attempt n is up to 0.5 * 2 ** n
+    assert sorted(clock.sleeps) == [0.5, 0.5, 0.5, 1.0, 1.0]
+
+
+def test_exectasks_does_not_retry_other_errors(clock):
+    def consumer(task):
+        raise ValueError(task)
+
+    results, failures = exectasks(0, ['a'], consumer, max_retries=5,
+                                  is_throttle=lambda err: isinstance(err, Throttled))
+    assert results == {}
+    assert isinstance(failures['a'], ValueError)
+    assert clock.sleeps == []